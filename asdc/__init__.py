@@ -18,9 +18,8 @@ import re
 import pathlib
 import shutil
 import zipfile
-from slugify import slugify
+import hashlib
 import requests
-from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
 
 # This is the server process launched by installed entrypoint
 # Whenever request is made on (jupyterhub_url)/asdc this server is started
@@ -36,16 +35,23 @@ def setup_asdc():
 import asdc.auth as auth    #For back compatibility
 from asdc.auth import *     #Also now available in root module
 from asdc.utils import *
+from asdc.images import *
+from asdc.export import *
 
-#Get the settings from env and store
-auth.setup()
-#Get the access tokens
-auth.authenticate()
+def slugify(text, **kwargs):
+    """
+    Convert text to a slug, see slugify.slugify() from python-slugify
+    """
+    from slugify import slugify
+    return slugify(text, **kwargs)
+
+#NOTE: Settings are loaded from env and tokens retrieved on first API use,
+# see auth.ensure_authenticated(), use auth.prewarm() to start this in the background
 
 project_dir = os.path.join(os.getenv('JUPYTER_SERVER_ROOT', '/home/jovyan/'), 'projects')
 
 #Utility functions
-def call_api(url, data=None, headersAPI=None, content_type='application/json', throw=True, prefix=auth.settings["token_prefix"]):
+def call_api(url, data=None, headersAPI=None, content_type='application/json', throw=True, prefix=None):
     """
     Call an API endpoint
 
@@ -63,6 +69,9 @@ def call_api(url, data=None, headersAPI=None, content_type='application/json', t
     object
         http response object
     """
+    #Setup and authenticate on first use
+    auth.ensure_authenticated()
+    prefix = prefix or auth.settings["token_prefix"]
     if url[0:4] != "http":
         #Prepend the configured api url
         url = auth.settings["api_audience"] + url
@@ -93,7 +102,7 @@ def call_api(url, data=None, headersAPI=None, content_type='application/json', t
     #print(r.text)
     return r
 
-def download(url, filename=None, block_size=8192, data=None, overwrite=False, throw=False, progress=True, silent=False, prefix=auth.settings["token_prefix"]):
+def download(url, filename=None, block_size=8192, data=None, overwrite=False, throw=False, progress=True, silent=False, prefix=None, proxy=True):
     """
     Call an API endpoint to download a file
 
@@ -109,12 +118,23 @@ def download(url, filename=None, block_size=8192, data=None, overwrite=False, th
         throw exception on http errors, default: False
     progress: bool
         Show progress bar
+    proxy: bool
+        Download through the local server's caching proxy if it is running,
+        so files requested by several kernels are only downloaded once
 
     Returns
     -------
     str
-        local filename saved
+        local filename saved, None if the request failed or the file is incomplete
     """
+    return _download(url, filename, block_size, data, overwrite, throw, progress, silent, prefix, proxy)[0]
+
+def _download(url, filename=None, block_size=8192, data=None, overwrite=False, throw=False, progress=True, silent=False, prefix=None, proxy=True):
+    #download(), also returns whether the whole file was received: (filename, checked)
+    #checked is only True if the response had a Content-Length and it matches the bytes written
+    #Setup and authenticate on first use
+    auth.ensure_authenticated()
+    prefix = prefix or auth.settings["token_prefix"]
     if url[0:4] != "http":
         #Prepend the configured api url
         url = auth.settings["api_audience"] + url
@@ -133,7 +153,7 @@ def download(url, filename=None, block_size=8192, data=None, overwrite=False, th
 
     if not overwrite and os.path.exists(filename):
         if not silent: print("File exists: " + filename)
-        return filename
+        return filename, False
 
     #Progress bar
     if progress:
@@ -145,14 +165,26 @@ def download(url, filename=None, block_size=8192, data=None, overwrite=False, th
     # NOTE the stream=True parameter below
     #https://stackoverflow.com/a/16696317
     #POST if data provided, otherwise GET
-    if data:
-        r = requests.post(url, headers=headersAPI, json=data, stream=True, cookies=auth.cookies)
-    else:
-        r = requests.get(url, headers=headersAPI, stream=True, cookies=auth.cookies)
+    r = None
+    if proxy and not data and not auth.cookies and auth.proxy_url(url):
+        try:
+            r = requests.get(auth.proxy_url(url), headers=headersAPI, stream=True, timeout=(5, None))
+            if not r.ok:
+                #Proxy or upstream error, download directly
+                r.close()
+                r = None
+        except (requests.exceptions.ConnectionError) as e:
+            #Server not available, download directly
+            pass
+    if r is None:
+        if data:
+            r = requests.post(url, headers=headersAPI, json=data, stream=True, cookies=auth.cookies)
+        else:
+            r = requests.get(url, headers=headersAPI, stream=True, cookies=auth.cookies)
     #with requests.get(url, headers=headersAPI, stream=True) as r:
     if not r.ok:
         if not silent: print("Error response:", r, url)
-        return None
+        return None, False
     else:
         total_size_in_bytes= int(r.headers.get('content-length', 0))
         got_bytes = 0
@@ -170,9 +202,44 @@ def download(url, filename=None, block_size=8192, data=None, overwrite=False, th
                 f.write(chunk)
         if progress:
             progress_bar.close()
+        if r.headers.get('content-encoding'):
+            #Content-Length is the compressed size
+            got_bytes = r.raw.tell()
         if total_size_in_bytes != 0 and got_bytes != total_size_in_bytes:
-            print("ERROR, something went wrong")
-    return filename
+            #Incomplete, don't leave a truncated file to be picked up later
+            print(f"ERROR, incomplete download, got {got_bytes} of {total_size_in_bytes} bytes:", url)
+            os.remove(filename)
+            return None, False
+    return filename, total_size_in_bytes != 0
+
+#Background downloads with no progress update for this many seconds are ignored
+PREFETCH_STALE = 60
+
+def _wait_for_prefetch(filename, progress=True):
+    """
+    Wait for a background download of filename by the server to finish
+
+    Returns
+    -------
+    bool
+        True if the file was downloaded
+    """
+    state = read_prefetch_progress(filename)
+    bar = None
+    while state and state["status"] == "downloading" and time.time() - state["time"] < PREFETCH_STALE:
+        if progress and bar is None:
+            if is_notebook():
+                from tqdm.notebook import tqdm
+            else:
+                from tqdm import tqdm
+            bar = tqdm(desc=os.path.basename(filename), total=state["total"], unit='iB', unit_scale=True, leave=False)
+        if bar is not None:
+            bar.update(state["bytes"] - bar.n)
+        time.sleep(0.5)
+        state = read_prefetch_progress(filename)
+    if bar is not None:
+        bar.close()
+    return bool(state) and state["status"] == "done" and os.path.exists(filename)
 
 def download_asset(filename, dest=None, project=None, task=None, overwrite=False, progress=True):
     """
@@ -194,6 +261,11 @@ def download_asset(filename, dest=None, project=None, task=None, overwrite=False
     #Use the default selections unless arg passed
     project, task = get_selection(project, task)
 
+    #Already being downloaded in the background by the server? (see server /import)
+    target = filename if dest is None else dest
+    if not overwrite and not os.path.exists(target) and _wait_for_prefetch(target, progress):
+        return target
+
     res = download(f'/projects/{project}/tasks/{task}/download/{filename}', filename=dest, overwrite=overwrite, progress=progress, silent=True)
     #If it failed, try the raw asset url
     if res is None:
@@ -202,7 +274,7 @@ def download_asset(filename, dest=None, project=None, task=None, overwrite=False
         res = download(f'/projects/{project}/tasks/{task}/assets/{filename}', filename=dest, overwrite=overwrite, progress=progress)
     return res
 
-def export_asset(asset, params, project=None, task=None, overwrite=False, progress=True):
+def export_asset(asset, params, project=None, task=None, overwrite=False, progress=True, cache=True, local=False):
     """
     Call WebODM API endpoints to export a converted asset file
     The existing asset file can be downloaded with the /download/fn endpoint
@@ -223,6 +295,11 @@ def export_asset(asset, params, project=None, task=None, overwrite=False, progre
         task ID
     progress: bool
         Show progress bar
+    cache: bool
+        Use the local export cache, see export_assets()
+    local: bool
+        Download the original asset and convert it locally instead of on the server,
+        (supported for: georeferenced_model, orthophoto, dsm, dtm)
 
 
     data {
@@ -257,38 +334,222 @@ def export_asset(asset, params, project=None, task=None, overwrite=False, progre
     <option value="csv">CSV</option>
 
     """
-    #Use the default selections unless arg passed
-    project, task = get_selection(project, task)
+    if local:
+        return export_local(asset, params, project=project, task=task, overwrite=overwrite, progress=progress)
+    return export_assets([(asset, params)], project=project, task=task, overwrite=overwrite, progress=progress, throw=True, cache=cache)[0]
+
+#Original asset files used for local exports
+LOCAL_EXPORT_SOURCES = {
+    "georeferenced_model": "georeferenced_model.laz",
+    "orthophoto": "orthophoto.tif",
+    "dsm": "dsm.tif",
+    "dtm": "dtm.tif",
+}
+#File extensions for the raster export formats
+RASTER_EXTENSIONS = {"gtiff": "tif", "gtiff-rgb": "tif", "jpg": "jpg", "png": "png", "kmz": "kmz"}
+
+def export_local(asset, params, project=None, task=None, overwrite=False, progress=True):
+    """
+    Export a converted asset file locally, the original asset is downloaded
+    and converted with the functions in asdc.export
 
-    #First post to /export, then get from the task
-    res = call_api(f'/projects/{project}/tasks/{task}/{asset}/export', data=params)
-    data = res.json()
-    if 'celery_task_id' in data:
-        # wait for the result to be available before continuing
-        worker_id = data['celery_task_id']
-        print("Processing request...", end='')
-        timeout_seconds = 60
-        result = {"ready": False}
-        for i in range(0,timeout_seconds):
-            time.sleep(1)
-            #Check the status
-            r = call_api(f'/workers/check/{worker_id}')
-            result = r.json()
-            if result["ready"]:
-                break
+    Parameters
+    ----------
+    asset: str
+        asset label to export, see LOCAL_EXPORT_SOURCES
+    params: dict
+        params for conversion, as for export_asset()
+    project: int
+        project ID
+    task: str
+        task ID
+    progress: bool
+        Show progress bar
+
+    Returns
+    -------
+    str
+        local filename saved
+    """
+    if not asset in LOCAL_EXPORT_SOURCES:
+        raise(Exception("Local export not supported for: " + asset))
+    src = download_asset(LOCAL_EXPORT_SOURCES[asset], project=project, task=task, progress=progress)
+    if src is None:
+        return None
+    default = "gtiff" if asset in ["orthophoto", "dsm", "dtm"] else os.path.splitext(src)[1][1:]
+    fmt = params.get("format", default).lower()
+    epsg = params.get("epsg")
+    ext = RASTER_EXTENSIONS.get(fmt, fmt)
+    name = asset if fmt != "gtiff-rgb" else asset + "_rgb"
+    dest = f"{name}_{epsg}.{ext}" if epsg else f"{name}.{ext}"
+    if dest == src:
+        return src
+    if not overwrite and os.path.exists(dest):
+        print("File exists: " + dest)
+        return dest
+
+    print("Processing request...", end='')
+    if asset == "georeferenced_model":
+        export_pointcloud(src, dest, format=fmt, epsg=epsg)
+    else:
+        export_raster(src, dest, format=fmt, epsg=epsg, colormap=params.get("color_map", "viridis"),
+                      shading=params.get("hillshade", True) not in [False, "none", 0])
+    print('.. done.')
+    return dest
+
+#Export time allowed per MB of task data, and the minimum
+EXPORT_TIMEOUT_PER_MB = 0.5
+EXPORT_TIMEOUT_MIN = 60
+
+def _task_version(info):
+    #Fingerprint of a task's processing state, changes when the task is reprocessed
+    #(the task API has no modified time)
+    fields = [info.get(k) for k in ['created_at', 'processing_time', 'status', 'size', 'available_assets']]
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[0:16]
+
+def _export_cache(project, task, asset, params, info):
+    #Cache directory for an export, any cached exports from older task versions are removed
+    key = hashlib.sha1(json.dumps([asset, params], sort_keys=True).encode()).hexdigest()[0:16]
+    parent = os.path.dirname(cache_path('exports', project, task, key, ''))
+    version = _task_version(info)
+    for v in os.listdir(parent):
+        if v != version:
+            shutil.rmtree(os.path.join(parent, v), ignore_errors=True)
+    path = os.path.join(parent, version)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _copy_file(src, dest):
+    #Hard link if possible, otherwise copy
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except (OSError) as e:
+        shutil.copyfile(src, dest)
+
+def export_assets(exports, project=None, task=None, overwrite=False, progress=True, timeout_seconds=None, workers=4, throw=False, cache=True):
+    """
+    Call WebODM API endpoints to export several converted asset files at once
+
+    All the exports are submitted first, then the pending workers are checked together
+    in each polling round, backing off while nothing changes. Each result is downloaded
+    as soon as it is ready.
+
+    Exported files are kept in a local cache, keyed by project, task, asset, params
+    and the task's processing state, repeat exports are copied from there
+    without calling the server. Cached exports are dropped when the task is reprocessed.
+
+    Parameters
+    ----------
+    exports: list
+        list of (asset, params) tuples, see export_asset(), or (asset, params, project, task)
+        to export from different tasks
+    project: int
+        project ID
+    task: str
+        task ID
+    progress: bool
+        Show progress bar
+    timeout_seconds: int
+        Time to wait for each export, default scales with the task size
+    workers: int
+        Number of concurrent status checks / downloads
+    throw: bool
+        Raise an exception if an export times out, default: False
+    cache: bool
+        Use the local export cache
+
+    Returns
+    -------
+    list
+        downloaded filenames (or responses for exports not processed by a worker),
+        None for any that failed, in the same order as exports
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    results = [None] * len(exports)
+    pending = {}
+    cache_dirs = {}
+    tasks_info = {}
+    for i, export in enumerate(exports):
+        asset, params = export[0], export[1]
+        #Use the default selections unless arg passed
+        p, t = get_selection(*export[2:4]) if len(export) > 2 else get_selection(project, task)
+        if (cache or timeout_seconds is None) and not (p, t) in tasks_info:
+            tasks_info[(p, t)] = call_api(f'/projects/{p}/tasks/{t}/').json()
+
+        if cache:
+            cache_dirs[i] = _export_cache(p, t, asset, params, tasks_info[(p, t)])
+            cached = os.listdir(cache_dirs[i])
+            if len(cached):
+                filename = cached[0]
+                if overwrite or not os.path.exists(filename):
+                    _copy_file(os.path.join(cache_dirs[i], filename), filename)
+                print(f"Using cached export: {filename}")
+                results[i] = filename
+                continue
+
+        #First post to /export, then get from the task
+        res = call_api(f'/projects/{p}/tasks/{t}/{asset}/export', data=params)
+        data = res.json()
+        if not 'celery_task_id' in data:
+            results[i] = res
+            continue
+
+        #Allow more time for larger tasks (size is in MB)
+        timeout = timeout_seconds
+        if timeout is None:
+            size = tasks_info[(p, t)].get('size', 0) or 0
+            timeout = max(EXPORT_TIMEOUT_MIN, EXPORT_TIMEOUT_PER_MB * size)
+        pending[data['celery_task_id']] = (i, data['filename'], time.time() + timeout)
+
+    if not len(pending):
+        return results
+
+    def check(worker_id):
+        return worker_id, call_api(f'/workers/check/{worker_id}').json()
+
+    def fetch(worker_id, filename):
+        return _download(f'/workers/get/{worker_id}?filename={filename}', filename, overwrite=overwrite, progress=progress)
+
+    print(f"Processing {len(pending)} export request(s)...", end='')
+    delay = 0.5
+    downloads = {}
+    with ThreadPoolExecutor(workers) as pool, ThreadPoolExecutor(workers) as download_pool:
+        while len(pending):
+            time.sleep(delay)
+            #Check all the pending workers together
+            changed = False
+            for worker_id, result in pool.map(check, list(pending)):
+                i, filename, expires = pending[worker_id]
+                if result.get("ready"):
+                    del pending[worker_id]
+                    changed = True
+                    if result.get("error"):
+                        print(f"\nExport failed: {exports[i][0]}: {result['error']}")
+                    else:
+                        #Start the download straight away
+                        downloads[i] = download_pool.submit(fetch, worker_id, filename)
+                elif time.time() > expires:
+                    del pending[worker_id]
+                    if throw:
+                        raise(Exception("Timed out awaiting result!"))
+                    print(f"\nTimed out awaiting result: {exports[i][0]}")
+            #Back off while nothing is changing
+            delay = 0.5 if changed else min(delay * 1.5, 10)
             print('.', end='')
             sys.stdout.flush()
-    
-        if not result["ready"]:
-            raise(Exception("Timed out awaiting result!"))
-        else:
-            print('.. done.')
-            filename = data['filename']
-            res = download(f'/workers/get/{worker_id}?filename={filename}', filename, overwrite=overwrite, progress=progress)
+        print('.. done.')
 
-    return res
+        for i in downloads:
+            results[i], checked = downloads[i].result()
+            #Only cache files known to be complete
+            if cache and checked:
+                _copy_file(results[i], os.path.join(cache_dirs[i], os.path.basename(results[i])))
 
-def upload(url, filepath, dest=None, block_size=8192, progress=True, throw=False, prefix=auth.settings["token_prefix"], **kwargs):
+    return results
+
+def upload(url, filepath, dest=None, block_size=8192, progress=True, throw=False, prefix=None, **kwargs):
     """
     Call an API endpoint to upload a file
 
@@ -296,8 +557,8 @@ def upload(url, filepath, dest=None, block_size=8192, progress=True, throw=False
     ----------
     url: str
         endpoint url, either full uri or path / which will be appended to "api_audience" url from settings
-    filepath: str
-        file path to open and upload
+    filepath: str/file
+        file path to open and upload, or a file-like object with the data (requires dest)
     dest: str
         destination filename, if omitted will use source
     progress: bool
@@ -312,6 +573,9 @@ def upload(url, filepath, dest=None, block_size=8192, progress=True, throw=False
     object
         http response object
     """
+    #Setup and authenticate on first use
+    auth.ensure_authenticated()
+    prefix = prefix or auth.settings["token_prefix"]
     if url[0:4] != "http":
         #Prepend the configured api url
         url = auth.settings["api_audience"] + url
@@ -327,26 +591,39 @@ def upload(url, filepath, dest=None, block_size=8192, progress=True, throw=False
     fields = kwargs
 
     #https://stackoverflow.com/a/67726532
-    path = pathlib.Path(filepath)
-    total_size = path.stat().st_size
-    if dest:
+    if hasattr(filepath, 'read'):
+        #File-like object, eg: in-memory image data
+        pos = filepath.tell()
+        total_size = filepath.seek(0, os.SEEK_END) - pos
+        filepath.seek(pos)
         filename = dest
     else:
-        filename = path.name
+        path = pathlib.Path(filepath)
+        total_size = path.stat().st_size
+        if dest:
+            filename = dest
+        else:
+            filename = path.name
+
+    from requests_toolbelt import MultipartEncoder, MultipartEncoderMonitor
+    def post(f, bar=None):
+        fields["file"] = (filename, f)
+        e = MultipartEncoder(fields=fields)
+        data = e
+        if bar:
+            m = MultipartEncoderMonitor(e, lambda monitor: bar.update(monitor.bytes_read - bar.n))
+            data = m
+        headers = {'Content-Type': data.content_type}
+        if not auth.cookies:
+            access_token = auth.get_token()
+            headers['Authorization'] = prefix + ' ' + access_token
+        return requests.post(url, data=data, headers=headers, cookies=auth.cookies)
 
     def do_upload(bar=None):
+        if hasattr(filepath, 'read'):
+            return post(filepath, bar)
         with open(filepath, "rb") as f:
-            fields["file"] = (filename, f)
-            e = MultipartEncoder(fields=fields)
-            data = e
-            if bar:
-                m = MultipartEncoderMonitor(e, lambda monitor: bar.update(monitor.bytes_read - bar.n))
-                data = m
-            headers = {'Content-Type': data.content_type}
-            if not auth.cookies:
-                access_token = auth.get_token()
-                headers['Authorization'] = prefix + ' ' + access_token
-            return requests.post(url, data=data, headers=headers, cookies=auth.cookies)
+            return post(f, bar)
 
     if progress:
         with tqdm(desc=filename, total=total_size, unit="B", unit_scale=True, unit_divisor=block_size, leave=False) as bar:
@@ -393,7 +670,7 @@ def upload_asset(filename, dest=None, project=None, task=None, progress=True):
         destfile = fn
     return upload(f'/projects/{project}/tasks/{task}/assets/{destpath}', filename, destfile, progress=progress)
 
-def upload_image(filename, project, task, progress=True):
+def upload_image(filename, project, task, progress=True, data=None):
     """
     Call WebODM API endpoint to upload a source image file
 
@@ -407,6 +684,9 @@ def upload_image(filename, project, task, progress=True):
         task ID
     progress: bool
         Show progress bar
+    data: file
+        file-like object to upload in place of the file contents,
+        eg: the resized image from resize_image_data()
 
     Returns
     -------
@@ -416,10 +696,174 @@ def upload_image(filename, project, task, progress=True):
     #Use the default selections unless arg passed
     project, task = get_selection(project, task)
 
+    if data is not None:
+        return upload(f'/projects/{project}/tasks/{task}/upload/', data, dest=os.path.basename(filename), progress=progress)
     return upload(f'/projects/{project}/tasks/{task}/upload/', filename, progress=progress)
 
+def image_exists(filename, project=None, task=None, prefix=None):
+    """
+    Check if a source image with this name has already been uploaded to a task
+
+    Parameters
+    ----------
+    filename: str
+        image filename (without path)
+    project: int
+        project ID
+    task: str
+        task ID
+
+    Returns
+    -------
+    bool
+        True if the image is found on the server
+    """
+    #Setup and authenticate on first use
+    auth.ensure_authenticated()
+    prefix = prefix or auth.settings["token_prefix"]
+    project, task = get_selection(project, task)
+    url = auth.settings["api_audience"] + f'/projects/{project}/tasks/{task}/images/download/{filename}'
+    headers = {}
+    if not auth.cookies:
+        headers['Authorization'] = prefix + ' ' + auth.get_token()
+    #HEAD only, don't fetch the image
+    r = requests.head(url, headers=headers, cookies=auth.cookies, allow_redirects=True)
+    return r.ok
 
-def call_api_js(url, callback="alert", data=None, prefix=auth.settings["token_prefix"]):
+def upload_images(filenames, project=None, task=None, progress=True, skip_existing=True, resize_to=None, workers=4, fast_resize=False, validate=True):
+    """
+    Upload a set of source images to a task, skipping images that are already there
+
+    A manifest of content hashes for uploaded images is kept per task in the local cache,
+    so re-running after a partial failure only sends the missing images.
+    Images not in the manifest are also checked against the task's images on the server,
+    and duplicate images (same content) in the local set are only sent once.
+
+    If resize_to is set, images are resized in memory and the resized data is uploaded,
+    the original files are not modified. Resizing and uploading are overlapped by running
+    each image through the pipeline on a pool of worker threads.
+
+    Parameters
+    ----------
+    filenames: list
+        image filenames to upload
+    project: int
+        project ID
+    task: str
+        task ID
+    progress: bool
+        Show progress bar
+    skip_existing: bool
+        Skip images already uploaded, if False all images are sent
+    resize_to: int
+        Resize images to this size (largest side) before uploading, default is no resize
+    workers: int
+        Number of images to resize / upload concurrently
+    fast_resize: bool
+        Use the faster, lower quality resize, see resize_image_data()
+    validate: bool
+        Check the images still to be uploaded with validate_images() first,
+        nothing is uploaded if any have errors
+
+    Returns
+    -------
+    dict
+        lists of filenames: "uploaded", "skipped" (already on server), "duplicates" and "failed"
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    #Use the default selections unless arg passed
+    project, task = get_selection(project, task)
+
+    manifest_fn = cache_path('uploads', f'{task}.json')
+    manifest = {}
+    if skip_existing and os.path.exists(manifest_fn):
+        with open(manifest_fn, 'r') as f:
+            try:
+                manifest = json.load(f)
+            except (json.decoder.JSONDecodeError) as e:
+                pass
+
+    #Nothing on the server? then the manifest is stale
+    images_count = 0
+    if skip_existing:
+        images_count = call_api(f'/projects/{project}/tasks/{task}/').json().get('images_count', 0)
+        if images_count == 0:
+            manifest = {}
+
+    def send(fn):
+        #Resize in memory (if requested) then upload, runs on the worker threads
+        data = None
+        if resize_to:
+            resized = resize_image_data(fn, resize_to, fast_resize)
+            if resized is not None:
+                data = resized['data']
+        return upload_image(fn, project, task, progress=progress and workers == 1, data=data)
+
+    result = {"uploaded": [], "skipped": [], "duplicates": [], "failed": []}
+    seen = set()
+    with ThreadPoolExecutor(workers) as pool:
+        hashes = pool.map(file_hash, filenames)
+        pending = {}
+        for fn, h in zip(filenames, hashes):
+            if h in seen:
+                result["duplicates"] += [fn]
+                continue
+            seen.add(h)
+            if skip_existing and images_count > 0:
+                if h in manifest or image_exists(os.path.basename(fn), project, task):
+                    manifest[h] = os.path.basename(fn)
+                    result["skipped"] += [fn]
+                    continue
+            pending[fn] = h
+
+        if validate and len(pending):
+            report = validate_images(list(pending))
+            if not report["valid"]:
+                for fn in report["errors"]:
+                    print(fn, report["errors"][fn])
+                raise(Exception("Invalid images found, nothing uploaded"))
+
+        #Overall progress when uploading several images at once
+        bar = None
+        if progress and workers > 1 and len(pending):
+            if is_notebook():
+                from tqdm.notebook import tqdm
+            else:
+                from tqdm import tqdm
+            bar = tqdm(desc="Uploading", total=len(pending), unit="images", leave=False)
+
+        jobs = {pool.submit(send, fn): fn for fn in pending}
+        for job in as_completed(jobs):
+            fn = jobs[job]
+            if bar:
+                bar.update(1)
+            try:
+                r = job.result()
+            except (Exception) as e:
+                print("Error uploading:", e, fn)
+                result["failed"] += [fn]
+                continue
+            if not r.ok:
+                print("Error response:", r, fn)
+                result["failed"] += [fn]
+                continue
+            result["uploaded"] += [fn]
+            #Save the manifest after every upload, so it is current if we fail part way
+            manifest[pending[fn]] = os.path.basename(fn)
+            with open(manifest_fn, 'w') as f:
+                json.dump(manifest, f)
+        if bar:
+            bar.close()
+
+    #Also records images found on the server
+    with open(manifest_fn, 'w') as f:
+        json.dump(manifest, f)
+
+    if len(result["skipped"]) or len(result["duplicates"]):
+        print(f"Skipped {len(result['skipped'])} images already uploaded, {len(result['duplicates'])} duplicates")
+    return result
+
+def call_api_js(url, callback="alert", data=None, prefix=None):
     """
     Call an API endpoint from the browser via Javascript, appends a script to the page to 
     do the request.
@@ -433,6 +877,9 @@ def call_api_js(url, callback="alert", data=None, prefix=auth.settings["token_pr
     data: dict
         json data for a POST request, if omitted will send a GET request
     """
+    #Setup and authenticate on first use
+    auth.ensure_authenticated()
+    prefix = prefix or auth.settings["token_prefix"]
     #GET, list nodes, passing url and token from python
     from IPython.display import display, HTML
     access_token = auth.get_token()
@@ -495,6 +942,7 @@ def userinfo():
     dict
         json dict containing user info
     """
+    auth.ensure_authenticated()
     r = call_api(auth.settings["api_authurl"] + '/userinfo') #, prefix='Bearer')
     data = r.json()
     return data
@@ -511,6 +959,7 @@ def showuserinfo():
 
 def load_projects_and_tasks(cache=project_dir):
     #Get user projects and task info from  public API
+    auth.ensure_authenticated()
     user = os.getenv('JUPYTERHUB_USER', '')
     url = auth.settings["api_audience"] + "/plugins/asdc/usertasks?email=" + user
     try:
@@ -538,6 +987,7 @@ def create_links(src='/mnt/project', dest=project_dir):
     if not os.path.exists(src): return
     prjfolders = [ f.path for f in os.scandir(src) if f.is_dir() ]
 
+    auth.ensure_authenticated()
     audience = auth.settings["api_audience"]
     if auth.access_token:
         #Can use authenticated API for each mounted project
@@ -596,8 +1046,26 @@ def create_links(src='/mnt/project', dest=project_dir):
             os.symlink(tpath, lnpath)
             idx += 1
 
+def _load_inputs():
+    #Load the passed projects/tasks and default selections on first use
+    global _inputs_loaded, selected
+    if not _inputs_loaded:
+        _inputs_loaded = True
+        if not 'selected' in globals():
+            selected = {"project": None, "task" : None}
+        get_tasks()
+        get_projects()
+
+def __getattr__(name):
+    #Module attributes loaded on first access (PEP 562), so import has no side effects
+    if name in ['selected', 'tasks', 'projects']:
+        _load_inputs()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def get_tasks():
     global selected, tasks
+    _load_inputs()
     inputs = read_inputs()
     tasks = inputs["tasks"]
     if len(tasks) and not selected["task"]:
@@ -606,6 +1074,7 @@ def get_tasks():
 
 def get_projects():
     global selected, projects
+    _load_inputs()
     inputs = read_inputs()
     projects = inputs["projects"]
     if len(projects) and not selected["project"]:
@@ -618,6 +1087,7 @@ def project_tasks(filtered=True, home=project_dir):
     Uses the full cached project/task data and filters by the list of passed items
     """
     global project_dict, task_dict
+    _load_inputs()
     tlist = get_tasks()
     plist = get_projects()
     output = []
@@ -654,6 +1124,8 @@ def project_tasks(filtered=True, home=project_dir):
 
 def selection_info():
     global selected
+    _load_inputs()
+    auth.ensure_authenticated()
     baseurl = settings['api_audience'] 
     if selected['project']:
         print(f"{baseurl}/projects/{selected['project']}/")
@@ -679,6 +1151,7 @@ def run_all_button():
 def get_task_project_options(filtered=False):
     #This populates the available project/tasks to select from
     #and the default / currently selected project and task
+    _load_inputs()
     pdata = project_tasks(filtered=filtered)
     if not pdata:
         return None, None, None, None
@@ -728,6 +1201,7 @@ def project_select(filtered=False):
         return
     import ipywidgets as widgets
     from IPython.display import display
+    _load_inputs()
 
     #Project selection widget
     pselections, tselections, init_p, init_t = get_task_project_options(filtered)
@@ -760,6 +1234,7 @@ def task_select(filtered=False):
         return
     import ipywidgets as widgets
     from IPython.display import display
+    _load_inputs()
 
     #Project/task selection widget
     pselections, tselections, init_p, init_t = get_task_project_options(filtered)
@@ -789,15 +1264,15 @@ def task_select(filtered=False):
     else:
         display(i, j)
 
-# Active selections
-selected = {"project": None, "task" : None}
-tasks = get_tasks()
-projects = get_projects()
+# Active selections: selected, tasks and projects are loaded from the inputs
+# on first use, see _load_inputs() and __getattr__()
+_inputs_loaded = False
 task_dict = {}
 project_dict = {}
 
 def set_selection(project, task):
     global selected
+    _load_inputs()
     # Update active selections
     selected = {"project": project, "task" : task}
 
@@ -809,6 +1284,7 @@ def get_selection(project=None, task=None, exception=True):
     (If project or task are passed these will override selections)
     """
     global selected, projects, tasks
+    _load_inputs()
     init_p = selected['project']
     init_t = selected['task']
     #Use params instead if provided
@@ -910,23 +1386,27 @@ def import_task(name, path=None, dest=None, project=None):
         with open(path, 'w') as f:
             f.write('{"custom_assets" : []}')
 
-    #Zip the files
+    #Zip the files, already compressed formats are stored as-is,
+    #the rest are deflated in parallel (see utils.zip_files)
     outfn = "/tmp/task.zip"
     if os.path.exists(outfn):
         os.remove(outfn)
+    files = []
     if os.path.isdir(path):
-        #We could use os.walk with zipfile below, but this is easier
-        zfile = shutil.make_archive('/tmp/task', 'zip', base_dir = path)
+        for root, dirs, filenames in os.walk(path):
+            for fn in sorted(filenames):
+                f = os.path.join(root, fn)
+                files += [(f, f)]
     else:
-        with zipfile.ZipFile(outfn, "w" ) as zfile:
-            if isinstance(path, str):
-                path = [path]
+        if isinstance(path, str):
+            path = [path]
 
-            for f in path:
-                if dest:
-                    zfile.write(f, os.path.join(dest, os.path.basename(path)), zipfile.ZIP_DEFLATED)
-                else:
-                    zfile.write(f, compress_type=zipfile.ZIP_DEFLATED)
+        for f in path:
+            if dest:
+                files += [(f, os.path.join(dest, os.path.basename(f)))]
+            else:
+                files += [(f, f)]
+    zip_files(outfn, files)
 
     #NOTE: Importing custom assets in zip will not add entries in files.json
     # until fixed, better to add them to the task with upload_asset
@@ -939,6 +1419,187 @@ def import_task(name, path=None, dest=None, project=None):
     task = res.json()
     return task["id"]
 
+#WebODM task status codes
+TASK_STATUS = {10: "QUEUED", 20: "RUNNING", 30: "FAILED", 40: "COMPLETED", 50: "CANCELED"}
+TASK_FINISHED = [30, 40, 50]
+
+class _TaskMonitor():
+    """
+    Tracks the state of a set of tasks being monitored by wait_for_tasks()
+
+    Each task gets its own next check time, based on how fast it is progressing,
+    the tasks in each project are all checked with a single request
+    """
+    def __init__(self, task_ids, project=None, interval=10, max_interval=120):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.tasks = {}
+        for t in task_ids:
+            #Accept (project, task) pairs or task ids in the selected project
+            p, t = get_selection(*t) if isinstance(t, (tuple, list)) else get_selection(project, t)
+            self.tasks[t] = {"project": p, "task": t, "status": None, "progress": 0.0,
+                             "checked": None, "due": 0, "info": None}
+        self.last_round = 0
+
+    def active(self):
+        return [s for s in self.tasks.values() if not s["status"] in TASK_FINISHED]
+
+    def wait(self):
+        """Returns the time to wait until the next round of checks is due"""
+        due = min(s["due"] for s in self.active())
+        #Rate limit, never check more often than interval
+        due = max(due, self.last_round + self.interval)
+        return max(0, due - time.time())
+
+    def due_projects(self):
+        now = time.time()
+        self.last_round = now
+        return sorted(set(s["project"] for s in self.active() if s["due"] <= now))
+
+    def update(self, project, tasks):
+        """
+        Update state from a project's task list, returns the tasks with a changed status
+        """
+        now = time.time()
+        changes = []
+        for info in tasks:
+            state = self.tasks.get(info["id"])
+            if state is None or state["project"] != project or state["status"] in TASK_FINISHED:
+                continue
+            status = info.get("status")
+            progress = info.get("running_progress") or 0.0
+            if status in TASK_FINISHED:
+                state["due"] = now
+            elif status == 20 and state["checked"] is not None and progress > state["progress"]:
+                #Estimate the time remaining from the progress rate, check again well before then
+                rate = (progress - state["progress"]) / (now - state["checked"])
+                remaining = (1.0 - progress) / rate
+                state["due"] = now + min(self.max_interval, max(self.interval, remaining / 4))
+            else:
+                #Queued or no progress since last check, back off
+                last = now - state["checked"] if state["checked"] else self.interval
+                state["due"] = now + min(self.max_interval, max(self.interval, last * 1.5))
+            state["checked"] = now
+            state["progress"] = progress
+            state["info"] = info
+            if status != state["status"]:
+                state["status"] = status
+                changes += [self.result(state)]
+        #Tasks missing from the list, check again later
+        found = set(info["id"] for info in tasks)
+        for state in self.active():
+            if state["project"] == project and not state["task"] in found:
+                state["due"] = now + self.max_interval
+        return changes
+
+    def result(self, state):
+        return {"project": state["project"], "task": state["task"], "status": state["status"],
+                "status_name": TASK_STATUS.get(state["status"], "UNKNOWN"),
+                "progress": state["progress"], "info": state["info"]}
+
+    def progress_bar(self, progress=True):
+        if not progress:
+            return None
+        if is_notebook():
+            from tqdm.notebook import tqdm
+        else:
+            from tqdm import tqdm
+        return tqdm(desc="Tasks", total=len(self.tasks) * 100, unit="%", leave=False,
+                    bar_format="{desc}: {percentage:3.0f}%|{bar}| {postfix}")
+
+    def show(self, bar):
+        if bar is None:
+            return
+        total = 0
+        for s in self.tasks.values():
+            total += 100 if s["status"] in TASK_FINISHED else int(s["progress"] * 100)
+        counts = {}
+        for s in self.tasks.values():
+            name = TASK_STATUS.get(s["status"], "UNKNOWN").lower()
+            counts[name] = counts.get(name, 0) + 1
+        bar.update(total - bar.n)
+        bar.set_postfix(counts)
+
+def _project_tasks(project):
+    return project, call_api(f"/projects/{project}/tasks/").json()
+
+def wait_for_tasks(task_ids, project=None, interval=10, max_interval=120, timeout=None, progress=True):
+    """
+    Monitor several processing tasks until they are all finished
+
+    Each polling round requests the task list once per project, so the number of
+    requests does not grow with the number of tasks. Tasks are checked again based
+    on their progress rate, backing off while queued or not progressing.
+
+    Parameters
+    ----------
+    task_ids: list
+        task ids in the selected project, or (project, task) tuples
+    project: int
+        project ID, if omitted will use current selection
+    interval: int
+        minimum time between polling rounds in seconds
+    max_interval: int
+        maximum time between checks of a task in seconds
+    timeout: int
+        raise an exception if the tasks are not all finished in this many seconds
+    progress: bool
+        Show a combined progress bar for all the tasks
+
+    Yields
+    ------
+    dict
+        status changes: project, task, status, status_name, progress and the task info
+
+    eg:
+    for change in wait_for_tasks([task1, task2]):
+        print(change["task"], change["status_name"])
+    """
+    monitor = _TaskMonitor(task_ids, project, interval, max_interval)
+    expires = time.time() + timeout if timeout else None
+    bar = monitor.progress_bar(progress)
+    try:
+        while len(monitor.active()):
+            delay = monitor.wait()
+            if expires and time.time() + delay > expires:
+                raise(Exception("Timed out awaiting tasks!"))
+            time.sleep(delay)
+            for p in monitor.due_projects():
+                yield from monitor.update(*_project_tasks(p))
+            monitor.show(bar)
+    finally:
+        if bar is not None:
+            bar.close()
+
+async def wait_for_tasks_async(task_ids, project=None, interval=10, max_interval=120, timeout=None, progress=True):
+    """
+    Async iterator version of wait_for_tasks(), see wait_for_tasks() for parameters
+
+    The requests for each project are made concurrently in worker threads
+
+    eg:
+    async for change in wait_for_tasks_async([task1, task2]):
+        print(change["task"], change["status_name"])
+    """
+    import asyncio
+    monitor = _TaskMonitor(task_ids, project, interval, max_interval)
+    expires = time.time() + timeout if timeout else None
+    bar = monitor.progress_bar(progress)
+    try:
+        while len(monitor.active()):
+            delay = monitor.wait()
+            if expires and time.time() + delay > expires:
+                raise(Exception("Timed out awaiting tasks!"))
+            await asyncio.sleep(delay)
+            results = await asyncio.gather(*[asyncio.to_thread(_project_tasks, p) for p in monitor.due_projects()])
+            for p, tasks in results:
+                for change in monitor.update(p, tasks):
+                    yield change
+            monitor.show(bar)
+    finally:
+        if bar is not None:
+            bar.close()
+
 def snapshot(source_dir, project_id, task_id):
     """
     Take a snapshot of the current pipeline code and store it as a zip file
@@ -56,8 +56,9 @@ import logging
 import datetime
 import time
 import sys
+import threading
+from collections import deque
 from pathlib import Path
-import jwt
 from asdc.utils import *
 
 baseurl = ''      #Base jupyterhub url
@@ -67,6 +68,17 @@ port = None       #Server port, default is to automatically assign
 nonce = ''        #For verifying token
 _server = None     #Server to receive token
 cookies = None
+refresh_latency = deque(maxlen=100) #Recent (time, seconds taken) for each background token refresh
+_refresher = None  #Background token refresh thread
+_refresher_pid = None
+_authenticated = False #Setup and authentication done, see ensure_authenticated()
+_auth_lock = threading.Lock()
+
+#Renew the token in the background this many seconds before it expires
+#(the server renews earlier than this, see asdc.server.REFRESH_MARGIN)
+REFRESH_MARGIN = 120
+#Wait before retrying a failed or early refresh
+REFRESH_RETRY = 15
 
 #Settings, to be provided before use
 settings = {
@@ -381,10 +393,113 @@ def _send(mode='iframe'):
     script = temp_obj.substitute(URL=authurl, ID="auth_" + nonce, MODE=mode, PORT=port, NOW=str(int(time.time())))
     display(HTML(script))
 
+def _unix_get(socket_path, url, timeout=10):
+    """
+    Send a GET request over a unix domain socket, returns (status, body)
+    """
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(socket_path)
+
+    conn = UnixHTTPConnection('localhost', timeout=timeout)
+    try:
+        conn.request('GET', url, headers={'Content-type': 'application/json'})
+        r = conn.getresponse()
+        return r.status, r.read()
+    finally:
+        conn.close()
+
+def _request_token():
+    """
+    Request the token data from the server,
+    using the unix domain socket if available, otherwise the port
+    """
+    socket_path = server_socket_path()
+    if os.path.exists(socket_path):
+        try:
+            status, body = _unix_get(socket_path, '/tokens')
+            if status < 400:
+                logging.info("Server responded OK via socket: {}".format(status))
+                return json.loads(body)
+            #Not authenticated yet
+            if port is None:
+                return None
+        except (OSError) as e:
+            #Stale socket, server not running
+            logging.info(f"Server socket not available: {e}")
+
+    if port is None:
+        return None
+
+    server = f"http://localhost:{port}/tokens"
+    r = requests.get(server, headers={'Content-type': 'application/json'})
+
+    if r.status_code >= 400:
+        logging.info("Server responded error: {} {}".format(r.status_code, r.reason))
+        raise(Exception("Server responded with error"))
+    else:
+        logging.info("Server responded OK: {} {}".format(r.status_code, r.reason))
+        return r.json()
+
+def _fetch_token(margin=TOKEN_CACHE_MARGIN):
+    """
+    Get the token data from the token cache file, or the server if not cached
+    """
+    data = read_token_cache(margin)
+    if data:
+        return data
+    data = _request_token()
+    if data:
+        write_token_cache(data)
+    return data
+
+def _refresh_loop():
+    """
+    Renew the token before it expires, so requests never wait for a refresh
+    """
+    global token_data, access_token
+    delay = None
+    while True:
+        data = token_data
+        if delay is None:
+            delay = data['expires_at'] - REFRESH_MARGIN - time.time() if data else REFRESH_RETRY
+        time.sleep(max(1, delay))
+        delay = REFRESH_RETRY
+        start = time.time()
+        try:
+            new_data = _fetch_token(REFRESH_MARGIN)
+        except (Exception) as e:
+            logging.info(f"Background token refresh failed: {e}")
+            continue
+        #Retry until the server has a renewed token
+        if new_data and (not token_data or new_data['expires_at'] > token_data['expires_at']):
+            refresh_latency.append((start, time.time() - start))
+            token_data = new_data
+            access_token = new_data['access_token']
+            delay = None
+
+def _start_refresher():
+    global _refresher, _refresher_pid
+    #Threads are not copied to forked processes, so check the pid too
+    if _refresher is not None and _refresher_pid == os.getpid():
+        return
+    _refresher_pid = os.getpid()
+    _refresher = threading.Thread(target=_refresh_loop, name="asdc-token-refresh", daemon=True)
+    _refresher.start()
+
 def get_token():
     """
     Calls the server endpoint to get preloaded OAuth2 tokens
     - If tokens have expired they are automatically refreshed
+    - The token cache file written by the server is checked first,
+      avoiding a request to the server in each new kernel / process
+    - The server is requested over its unix domain socket if available
+    - Once a token is retrieved it is renewed in a background thread before it expires
 
     Returns
     -------
@@ -405,26 +520,54 @@ def get_token():
 
     #Send the token request
     if not token_data:
-        if port is None:
+        token_data = _fetch_token()
+        if token_data is None and port is None:
             return None
 
-        server = f"http://localhost:{port}/tokens"
-        r = requests.get(server, headers={'Content-type': 'application/json'})
-
-        if r.status_code >= 400:
-            logging.info("Server responded error: {} {}".format(r.status_code, r.reason))
-            raise(Exception("Server responded with error"))
-        else:
-            logging.info("Server responded OK: {} {}".format(r.status_code, r.reason))
-            token_data = r.json()
-
         if not token_data:
             raise(Exception("Unable to retrieve access token! "))
 
         access_token = token_data['access_token']
 
+    _start_refresher()
     return access_token
 
+def proxy_url(url):
+    """
+    Get the url to request an API url through the local server's caching proxy
+
+    Parameters
+    ----------
+    url: str
+        full API url
+
+    Returns
+    -------
+    str
+        proxy url, or None if the server is not running or the url is not an API url
+    """
+    audience = settings["api_audience"]
+    if port is None or not url.startswith(audience + '/'):
+        return None
+    return f"http://localhost:{port}/cache/" + url[len(audience)+1:]
+
+class TokenAuth(requests.auth.AuthBase):
+    """
+    Authentication for requests sessions that always uses the current access token,
+    so long lived sessions pick up tokens renewed in the background
+
+    eg:
+    >>> s = requests.Session()
+    ... s.auth = asdc.auth.TokenAuth()
+    """
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+
+    def __call__(self, r):
+        prefix = self.prefix or settings["token_prefix"]
+        r.headers['Authorization'] = f"{prefix} {get_token()}"
+        return r
+
 def authenticate(config=None): #, scope=""):
     """
     Calls the server endpoint to get preloaded OAuth2 tokens
@@ -448,6 +591,10 @@ def authenticate(config=None): #, scope=""):
     #(If not found, wait for authentication via popup or user action)
     data = read_inputs()
     port = data["port"]
+    if port is None and _fetch_token():
+        #No server port, but have a valid cached token or the server socket
+        get_token()
+        return
     if port is None:
         #Server not yet started, provide a button to manually authenticate
         if is_notebook():
@@ -513,6 +660,50 @@ def authenticate(config=None): #, scope=""):
     #Get the tokens, checking expiry and renewing if necessary
     get_token()
 
+def ensure_authenticated():
+    """
+    Load the settings from env and get the tokens, if not already done
+
+    Called on first use by the API functions, so importing the module has no side effects
+    """
+    global _authenticated
+    if _authenticated:
+        return
+    with _auth_lock:
+        if _authenticated:
+            return
+        if not settings["provided"]:
+            setup()
+        authenticate()
+        _authenticated = True
+
+def prewarm():
+    """
+    Load the settings and get the tokens in a background thread,
+    so they are ready before the first API call
+
+    Does nothing if the tokens are not yet available, the first API call
+    will then prompt to authenticate as usual
+
+    Returns
+    -------
+    Thread
+        the background thread
+    """
+    def run():
+        try:
+            with _auth_lock:
+                if not settings["provided"]:
+                    setup()
+            if read_inputs()["port"] is not None or read_token_cache() or os.path.exists(server_socket_path()):
+                ensure_authenticated()
+        except (Exception) as e:
+            logging.info(f"Prewarm failed: {e}")
+
+    thread = threading.Thread(target=run, name="asdc-prewarm", daemon=True)
+    thread.start()
+    return thread
+
 async def connect(config=None, mode='iframe', timeout_seconds=30, scope=""):
     """
     Authenticate with the OAuth2 id provider
@@ -564,6 +755,7 @@ async def connect(config=None, mode='iframe', timeout_seconds=30, scope=""):
     #Have a token already? Check if it is expired
     if token_data:
         #Need to decode the access_token as it seems it expires earlier than id_token
+        import jwt
         access = jwt.decode(token_data['access_token'], options={"verify_signature": False})
         its = int(token_data['id_token']['exp'])
         idt = datetime.datetime.fromtimestamp(its)
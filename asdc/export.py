@@ -0,0 +1,395 @@
+"""
+# ASDC Local export functions
+
+## Australian Scalable Drone Cloud API module
+
+Convert downloaded assets locally, as an alternative to the WebODM export workers
+
+Requires laspy (with lazrs for LAZ) and pyproj for point clouds, rasterio for rasters,
+install with: pip install asdc[export]
+
+"""
+
+import logging
+logger = logging.getLogger('app.logger')
+import os
+import threading
+from collections import deque
+
+#Point cloud export formats, as provided by the server export
+POINTCLOUD_FORMATS = ['laz', 'las', 'ply', 'csv']
+
+def _transformer(src_crs, epsg, local):
+    #pyproj transformers are not thread safe, one per thread
+    if not hasattr(local, 'transformer'):
+        from pyproj import Transformer
+        local.transformer = Transformer.from_crs(src_crs, f"EPSG:{epsg}", always_xy=True)
+    return local.transformer
+
+def _ply_header(count, rgb):
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {count}",
+              "property double x", "property double y", "property double z"]
+    if rgb:
+        header += ["property uchar red", "property uchar green", "property uchar blue"]
+    return ("\n".join(header) + "\nend_header\n").encode()
+
+def export_pointcloud(src, dest, format=None, epsg=None, chunk_size=1000000, workers=None):
+    """
+    Convert a point cloud (eg: georeferenced_model.laz) to LAS/LAZ/PLY/CSV, optionally reprojecting
+
+    The source is read in chunks and each chunk is reprojected and written before the
+    next is read, so memory use is bounded by chunk_size x workers. Reprojection of
+    chunks runs on a thread pool (LAZ decompression is also parallel with lazrs).
+
+    Parameters
+    ----------
+    src: str
+        source LAS/LAZ file
+    dest: str
+        destination file
+    format: str
+        'laz', 'las', 'ply' or 'csv', default is from the dest extension
+    epsg: int
+        EPSG code of the coordinate system to reproject to, default is no reprojection
+    chunk_size: int
+        number of points per chunk
+    workers: int
+        number of reprojection threads, default is the cpu count
+
+    Returns
+    -------
+    str
+        destination file written
+    """
+    import numpy as np
+    import laspy
+    from concurrent.futures import ThreadPoolExecutor
+    if format is None:
+        format = os.path.splitext(dest)[1][1:]
+    format = format.lower()
+    if format not in POINTCLOUD_FORMATS:
+        raise ValueError("Unsupported point cloud format: " + format)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with laspy.open(src) as reader:
+        header = reader.header
+        rgb = 'red' in header.point_format.dimension_names
+        local = threading.local()
+        if epsg:
+            src_crs = header.parse_crs()
+            if src_crs is None:
+                raise ValueError("No coordinate system found in " + src)
+
+        def convert(points):
+            #Scaled coordinates, reprojected if requested
+            x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+            if epsg:
+                x, y, z = _transformer(src_crs, epsg, local).transform(x, y, z)
+            return points, x, y, z
+
+        writer = None
+        if format in ['las', 'laz']:
+            out_header = laspy.LasHeader(point_format=header.point_format, version=header.version)
+            out_header.scales = header.scales
+            out_header.offsets = header.offsets
+            if epsg:
+                from pyproj import CRS, Transformer
+                crs = CRS.from_epsg(epsg)
+                if crs.is_geographic:
+                    out_header.scales = np.array([1e-7, 1e-7, header.scales[2]])
+                t = Transformer.from_crs(src_crs, crs, always_xy=True)
+                out_header.offsets = np.array(t.transform(*header.offsets))
+                out_header.add_crs(crs)
+            else:
+                out_header.vlrs = header.vlrs
+            writer = laspy.open(dest, mode='w', header=out_header, do_compress=format == 'laz')
+            out = writer
+        else:
+            out = open(dest, 'wb')
+            if format == 'ply':
+                out.write(_ply_header(header.point_count, rgb))
+            else:
+                out.write((",".join(['X', 'Y', 'Z', 'Intensity', 'Classification'] + (['Red', 'Green', 'Blue'] if rgb else [])) + "\n").encode())
+
+        def write(points, x, y, z):
+            if writer:
+                record = laspy.ScaleAwarePointRecord.zeros(len(points), header=writer.header)
+                for name in points.point_format.dimension_names:
+                    if name not in ['X', 'Y', 'Z']:
+                        record[name] = points[name]
+                record.x, record.y, record.z = x, y, z
+                writer.write_points(record)
+            elif format == 'ply':
+                fields = [('x', '<f8'), ('y', '<f8'), ('z', '<f8')]
+                if rgb:
+                    fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+                data = np.empty(len(points), dtype=fields)
+                data['x'], data['y'], data['z'] = x, y, z
+                if rgb:
+                    #LAS colours are 16 bit
+                    for c in ['red', 'green', 'blue']:
+                        data[c] = np.asarray(points[c]) >> 8
+                out.write(data.tobytes())
+            else:
+                columns = [x, y, z, np.asarray(points.intensity), np.asarray(points.classification)]
+                fmt = ['%.3f'] * 3 + ['%d'] * 2
+                if epsg and np.abs(x).max(initial=0) <= 360:
+                    fmt[0:2] = ['%.8f', '%.8f']
+                if rgb:
+                    columns += [np.asarray(points[c]) for c in ['red', 'green', 'blue']]
+                    fmt += ['%d'] * 3
+                np.savetxt(out, np.column_stack(columns), fmt=fmt, delimiter=',')
+
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                #Bounded queue of chunks, written in order
+                jobs = deque()
+                for points in reader.chunk_iterator(chunk_size):
+                    if len(jobs) >= workers:
+                        write(*jobs.popleft().result())
+                    jobs.append(pool.submit(convert, points))
+                while len(jobs):
+                    write(*jobs.popleft().result())
+        finally:
+            out.close()
+
+    logger.info("Exported {} to {}".format(src, dest))
+    return dest
+
+#Raster export formats, as provided by the server export
+RASTER_FORMATS = ['gtiff', 'gtiff-rgb', 'jpg', 'png', 'kmz']
+
+#Built in colour ramps (used if matplotlib is not installed), stops from 0 to 1
+COLOUR_RAMPS = {
+    'viridis': [(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)],
+    'jet': [(0, 0, 128), (0, 0, 255), (0, 255, 255), (255, 255, 0), (255, 0, 0), (128, 0, 0)],
+    'terrain': [(51, 51, 153), (0, 153, 255), (0, 204, 102), (255, 255, 153), (128, 92, 84), (255, 255, 255)],
+    'gray': [(0, 0, 0), (255, 255, 255)],
+}
+
+def colourise(values, colormap='viridis'):
+    """
+    Apply a colour map to an array of values scaled from 0 to 1
+
+    Parameters
+    ----------
+    values: array
+        array of values (0-1)
+    colormap: str
+        matplotlib colour map name if matplotlib is installed, otherwise one of COLOUR_RAMPS
+
+    Returns
+    -------
+    array
+        uint8 RGB array, shape (3, ...) in rasterio band order
+    """
+    import numpy as np
+    values = np.clip(values, 0, 1)
+    if not colormap in COLOUR_RAMPS:
+        try:
+            import matplotlib
+            rgba = matplotlib.colormaps[colormap](values, bytes=True)
+            return np.moveaxis(rgba[..., 0:3], -1, 0)
+        except (ImportError, KeyError) as e:
+            logger.warning("Colour map {} not available, using viridis".format(colormap))
+            colormap = 'viridis'
+    ramp = np.array(COLOUR_RAMPS[colormap], dtype=np.float32)
+    stops = np.linspace(0, 1, len(ramp))
+    return np.stack([np.interp(values, stops, ramp[:, c]) for c in range(3)]).astype(np.uint8)
+
+def hillshade(elevation, xres, yres, azimuth=315, altitude=45):
+    """
+    Calculate hillshading for an elevation array
+
+    Parameters
+    ----------
+    elevation: array
+        2d array of elevations
+    xres, yres: float
+        pixel size, in the same units as the elevation
+    azimuth, altitude: float
+        light direction in degrees
+
+    Returns
+    -------
+    array
+        shading from 0 (dark) to 1 (fully lit)
+    """
+    import numpy as np
+    dy, dx = np.gradient(elevation.astype(np.float32), yres, xres)
+    slope = np.pi / 2 - np.arctan(np.hypot(dx, dy))
+    aspect = np.arctan2(-dx, dy)
+    az = np.radians(360 - azimuth + 90)
+    alt = np.radians(altitude)
+    shade = np.sin(alt) * np.sin(slope) + np.cos(alt) * np.cos(slope) * np.cos(az - aspect)
+    return np.clip(shade, 0, 1)
+
+def _open_raster(src, epsg, local, opened):
+    #Datasets are not thread safe, one per thread (warped if reprojecting)
+    #everything opened is added to the opened list, to be closed in reverse order
+    if not hasattr(local, 'dataset'):
+        import rasterio
+        from rasterio.vrt import WarpedVRT
+        local.dataset = rasterio.open(src)
+        opened.append(local.dataset)
+        if epsg:
+            local.dataset = WarpedVRT(local.dataset, crs=f"EPSG:{epsg}")
+            opened.append(local.dataset)
+    return local.dataset
+
+def _read_padded(ds, window, band, pad):
+    #Read a window of one band with extra pixels around it, edge values are repeated outside the raster
+    import numpy as np
+    from rasterio.windows import Window
+    col0 = max(0, window.col_off - pad)
+    row0 = max(0, window.row_off - pad)
+    col1 = min(ds.width, window.col_off + window.width + pad)
+    row1 = min(ds.height, window.row_off + window.height + pad)
+    data = ds.read(band, window=Window(col0, row0, col1 - col0, row1 - row0), masked=True)
+    widths = ((row0 - (window.row_off - pad), window.row_off + window.height + pad - row1),
+              (col0 - (window.col_off - pad), window.col_off + window.width + pad - col1))
+    if any(w for w in widths[0] + widths[1]):
+        mask = np.pad(np.ma.getmaskarray(data), widths, mode='edge')
+        data = np.ma.masked_array(np.pad(data.filled(0), widths, mode='edge'), mask)
+    return data
+
+def export_raster(src, dest, format='gtiff-rgb', epsg=None, colormap='viridis', shading=True, block_size=512, workers=None):
+    """
+    Convert an orthophoto or DSM GeoTIFF (eg: orthophoto.tif, dsm.tif) to another format,
+    optionally reprojecting
+
+    The raster is processed in windows on a pool of threads, single band rasters
+    (DSM) are coloured with a colour map and hillshading for the RGB formats.
+    GeoTIFF output is tiled with internal overviews.
+
+    Parameters
+    ----------
+    src: str
+        source GeoTIFF
+    dest: str
+        destination file
+    format: str
+        'gtiff' (raw data), 'gtiff-rgb', 'jpg', 'png' or 'kmz'
+    epsg: int
+        EPSG code of the coordinate system to reproject to, default is no reprojection
+        (kmz is always EPSG:4326)
+    colormap: str
+        colour map for single band rasters, see colourise()
+    shading: bool
+        apply hillshading to single band rasters
+    block_size: int
+        size of the windows processed and the output tiles
+    workers: int
+        number of threads, default is the cpu count
+
+    Returns
+    -------
+    str
+        destination file written
+    """
+    import numpy as np
+    import tempfile
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+    from concurrent.futures import ThreadPoolExecutor
+    format = format.lower()
+    if format not in RASTER_FORMATS:
+        raise ValueError("Unsupported raster format: " + format)
+    if format == 'kmz':
+        epsg = 4326
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    local = threading.local()
+    opened = []
+    ds = _open_raster(src, epsg, local, opened)
+    raw = format == 'gtiff'
+    single = ds.count == 1 or ds.count == 2 and ds.colorinterp[1] == rasterio.enums.ColorInterp.alpha
+    profile = dict(driver='GTiff', width=ds.width, height=ds.height, crs=ds.crs, transform=ds.transform,
+                   tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate', BIGTIFF='IF_SAFER')
+    if raw:
+        profile.update(count=ds.count, dtype=ds.dtypes[0], nodata=ds.nodata)
+    else:
+        #RGB with alpha, except JPEG
+        profile.update(count=3 if format == 'jpg' else 4, dtype='uint8', nodata=None, photometric='RGB')
+
+    if single and not raw:
+        #Colour scale range from a decimated read of the whole raster
+        factor = max(1, max(ds.width, ds.height) // 1024)
+        sample = ds.read(1, out_shape=(max(1, ds.height // factor), max(1, ds.width // factor)), masked=True).compressed()
+        vmin, vmax = np.percentile(sample, [2, 98]) if len(sample) else (0, 1)
+        xres, yres = abs(ds.transform.a), abs(ds.transform.e)
+        if ds.crs and ds.crs.is_geographic:
+            #Degrees to metres for the shading
+            lat = np.radians((ds.bounds.top + ds.bounds.bottom) / 2)
+            xres, yres = xres * 111320 * np.cos(lat), yres * 110540
+
+    def process(window):
+        dataset = _open_raster(src, epsg, local, opened)
+        if raw:
+            return window, dataset.read(window=window)
+        if single:
+            pad = 1 if shading else 0
+            data = _read_padded(dataset, window, 1, pad)
+            rgb = colourise((data.filled(vmin) - vmin) / max(vmax - vmin, 1e-9), colormap).astype(np.float32)
+            if shading:
+                rgb *= 0.4 + 0.6 * hillshade(data.filled(vmin), xres, yres)
+            if pad:
+                rgb = rgb[:, pad:-pad, pad:-pad]
+                data = data[pad:-pad, pad:-pad]
+            alpha = np.where(np.ma.getmaskarray(data), 0, 255)
+        else:
+            data = dataset.read([1, 2, 3], window=window, masked=True)
+            if data.dtype != np.uint8:
+                data = np.ma.clip(data, 0, 255)
+            rgb = data.filled(0)
+            alpha = dataset.dataset_mask(window=window) if hasattr(dataset, 'dataset_mask') else np.full(rgb.shape[1:], 255)
+        out = np.concatenate([rgb, alpha[None]]) if profile['count'] == 4 else rgb
+        return window, out.astype(np.uint8)
+
+    tiff = dest
+    if not format.startswith('gtiff'):
+        #Write a GeoTIFF first, then copy to the output format
+        fd, tiff = tempfile.mkstemp(suffix='.tif', dir=os.path.dirname(os.path.abspath(dest)))
+        os.close(fd)
+    try:
+        with rasterio.open(tiff, 'w', **profile) as dst, ThreadPoolExecutor(workers) as pool:
+            if raw and ds.colorinterp:
+                dst.colorinterp = ds.colorinterp
+            #Bounded queue of windows, written from this thread
+            jobs = deque()
+            for ij, window in dst.block_windows(1):
+                if len(jobs) >= workers * 2:
+                    done, data = jobs.popleft().result()
+                    dst.write(data, window=done)
+                jobs.append(pool.submit(process, window))
+            while len(jobs):
+                done, data = jobs.popleft().result()
+                dst.write(data, window=done)
+
+        #Internal overviews
+        with rasterio.open(tiff, 'r+') as dst:
+            factors = []
+            f = 2
+            while max(dst.width, dst.height) // f >= block_size:
+                factors += [f]
+                f *= 2
+            if len(factors):
+                dst.build_overviews(factors, Resampling.nearest if raw else Resampling.average)
+                dst.update_tags(ns='rio_overview', resampling='nearest' if raw else 'average')
+
+        if not format.startswith('gtiff'):
+            driver = {'jpg': 'JPEG', 'png': 'PNG', 'kmz': 'KMLSUPEROVERLAY'}[format]
+            options = {'FORMAT': 'AUTO'} if format == 'kmz' else {}
+            rasterio.shutil.copy(tiff, dest, driver=driver, **options)
+    finally:
+        if tiff != dest and os.path.exists(tiff):
+            os.remove(tiff)
+        #Per-thread datasets and the main one
+        for dataset in reversed(opened):
+            dataset.close()
+
+    logger.info("Exported {} to {}".format(src, dest))
+    return dest
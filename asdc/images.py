@@ -0,0 +1,465 @@
+"""
+# ASDC Image set functions
+
+## Australian Scalable Drone Cloud API module
+
+Functions for preparing local folders of drone images before upload
+
+"""
+
+import logging
+logger = logging.getLogger('app.logger')
+import os
+import re
+import hashlib
+import datetime
+from asdc.utils import read_metadata, read_exif, cache_path
+
+#Image types that are indexed
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.tif', '.tiff']
+
+#Columns in the image index table
+INDEX_COLUMNS = ['path', 'mtime', 'bytes', 'width', 'height', 'lat', 'lon', 'alt', 'time',
+                 'make', 'model', 'pitch', 'yaw', 'roll']
+
+#XMP attributes for the gimbal / camera angles (DJI, MicaSense and others)
+XMP_ANGLES = {
+    'pitch': ['GimbalPitchDegree', 'Camera:Pitch', 'CameraPitch'],
+    'yaw': ['GimbalYawDegree', 'Camera:Yaw', 'CameraYaw'],
+    'roll': ['GimbalRollDegree', 'Camera:Roll', 'CameraRoll'],
+}
+
+def list_images(folder, recursive=False):
+    """
+    List the image files in a folder
+
+    Parameters
+    ----------
+    folder: str
+        path to the folder
+    recursive: bool
+        include images in sub folders
+
+    Returns
+    -------
+    list
+        sorted list of image paths
+    """
+    paths = []
+    if recursive:
+        for root, dirs, filenames in os.walk(folder):
+            paths += [os.path.join(root, fn) for fn in filenames]
+    else:
+        paths = [e.path for e in os.scandir(folder) if e.is_file()]
+    return sorted(p for p in paths if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS)
+
+def _rational(value):
+    #EXIF rational (num, den) to float
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], int):
+        return value[0] / value[1] if value[1] else float('nan')
+    return float(value)
+
+def _degrees(dms, ref):
+    #EXIF GPS degrees, minutes, seconds to decimal degrees
+    d, m, s = [_rational(v) for v in dms]
+    deg = d + m / 60.0 + s / 3600.0
+    if ref in (b'S', b'W', 'S', 'W'):
+        deg = -deg
+    return deg
+
+def _xmp_value(xmp, names):
+    #Find a numeric XMP value, stored as either an attribute or an element
+    for name in names:
+        m = re.search(name.encode() + rb'(?:="|>)\s*([-+]?[\d.]+)', xmp)
+        if m:
+            return float(m.group(1))
+    return float('nan')
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'ignore')
+    return value.strip('\x00 ') if value else ''
+
+def _index_row(path):
+    #Read one image row for the index from the header metadata
+    st = os.stat(path)
+    nan = float('nan')
+    row = {'path': path, 'mtime': st.st_mtime_ns, 'bytes': st.st_size, 'width': 0, 'height': 0,
+           'lat': nan, 'lon': nan, 'alt': nan, 'time': None, 'make': '', 'model': '',
+           'pitch': nan, 'yaw': nan, 'roll': nan}
+    try:
+        meta = read_metadata(path)
+        if meta['size']:
+            row['width'], row['height'] = meta['size']
+        exif = read_exif(path)
+    except (IOError, ValueError) as e:
+        logger.warning("Cannot read metadata for {}: {}".format(path, str(e)))
+        return row
+
+    gps = exif.get('GPS', {})
+    try:
+        if 2 in gps and 4 in gps:
+            row['lat'] = _degrees(gps[2], gps.get(1))
+            row['lon'] = _degrees(gps[4], gps.get(3))
+        if 6 in gps:
+            row['alt'] = _rational(gps[6]) * (-1 if gps.get(5) == 1 else 1)
+    except (ValueError, TypeError, ZeroDivisionError) as e:
+        logger.warning("Invalid GPS data in {}: {}".format(path, str(e)))
+
+    timestamp = exif.get('Exif', {}).get(36867) or exif.get('0th', {}).get(306)
+    if timestamp:
+        try:
+            row['time'] = datetime.datetime.strptime(_text(timestamp)[:19], '%Y:%m:%d %H:%M:%S')
+        except (ValueError) as e:
+            pass
+    row['make'] = _text(exif.get('0th', {}).get(271))
+    row['model'] = _text(exif.get('0th', {}).get(272))
+
+    if meta['xmp']:
+        for key in XMP_ANGLES:
+            row[key] = _xmp_value(meta['xmp'], XMP_ANGLES[key])
+    return row
+
+def _to_columns(rows):
+    #List of row dicts to dict of NumPy arrays
+    import numpy as np
+    index = {}
+    for col in INDEX_COLUMNS:
+        values = [r[col] for r in rows]
+        if col in ['path', 'make', 'model']:
+            index[col] = np.array(values, dtype=str)
+        elif col == 'time':
+            index[col] = np.array([np.datetime64(v, 's') if v else np.datetime64('NaT', 's') for v in values], dtype='datetime64[s]')
+        elif col in ['mtime', 'bytes', 'width', 'height']:
+            index[col] = np.array(values, dtype=np.int64)
+        else:
+            index[col] = np.array(values, dtype=np.float64)
+    return index
+
+def select_images(index, rows):
+    """
+    Select rows from an image index
+
+    Parameters
+    ----------
+    index: dict
+        image index table from index_images()
+    rows: array
+        boolean mask or integer indices of the rows to keep
+
+    Returns
+    -------
+    dict
+        new index table with only the selected rows
+    """
+    return {col: index[col][rows] for col in index}
+
+def index_images(folder, workers=8, cache=True, recursive=False):
+    """
+    Build an index of the location, time and camera details of the images in a folder
+
+    Only the EXIF/XMP header bytes of each image are read, on a pool of threads.
+    The index is cached per folder, only new or modified images are read again.
+
+    Parameters
+    ----------
+    folder: str
+        path to the image folder
+    workers: int
+        number of threads reading image headers
+    cache: bool
+        use and update the cached index
+    recursive: bool
+        include images in sub folders
+
+    Returns
+    -------
+    dict
+        columnar table, dict of NumPy arrays with one entry per image:
+        path, mtime, bytes, width, height, lat, lon, alt (GPS altitude),
+        time (datetime64), make, model, pitch, yaw, roll (gimbal angles, degrees)
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    paths = list_images(folder, recursive)
+
+    #Reuse the cached rows for images that haven't changed
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+    cache_fn = cache_path('index', key + '.npz')
+    cached = {}
+    if cache and os.path.exists(cache_fn):
+        try:
+            with np.load(cache_fn) as data:
+                old = {col: data[col] for col in INDEX_COLUMNS}
+            cached = {p: i for i, p in enumerate(old['path'])}
+        except (Exception) as e:
+            logger.warning("Ignoring invalid index cache {}: {}".format(cache_fn, str(e)))
+
+    reuse = []
+    read = []
+    for p in paths:
+        i = cached.get(p)
+        if i is not None and old['mtime'][i] == os.stat(p).st_mtime_ns:
+            reuse += [i]
+        else:
+            read += [p]
+
+    with ThreadPoolExecutor(workers) as pool:
+        rows = list(pool.map(_index_row, read))
+    index = _to_columns(rows)
+    if len(reuse):
+        index = {col: np.concatenate([old[col][reuse], index[col]]) for col in INDEX_COLUMNS}
+    index = select_images(index, np.argsort(index['path'], kind='stable'))
+
+    if cache and (len(read) or len(reuse) != len(cached)):
+        tmp = cache_fn + '.tmp.npz'
+        np.savez(tmp, **index)
+        os.replace(tmp, cache_fn)
+    return index
+
+def filter_images(index, bbox=None, start=None, end=None):
+    """
+    Filter an image index by area and time
+
+    Parameters
+    ----------
+    index: dict
+        image index table from index_images()
+    bbox: tuple
+        (min_lon, min_lat, max_lon, max_lat), images without GPS position are excluded
+    start: datetime/str
+        only images taken at or after this time, eg: '2023-05-01T09:00'
+    end: datetime/str
+        only images taken before this time
+
+    Returns
+    -------
+    dict
+        new index table with the matching images
+    """
+    import numpy as np
+    mask = np.ones(len(index['path']), dtype=bool)
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        mask &= (index['lon'] >= min_lon) & (index['lon'] <= max_lon)
+        mask &= (index['lat'] >= min_lat) & (index['lat'] <= max_lat)
+    if start is not None:
+        mask &= index['time'] >= np.datetime64(start, 's')
+    if end is not None:
+        mask &= index['time'] < np.datetime64(end, 's')
+    return select_images(index, mask)
+
+def _dhash(path):
+    #Difference hash of a downscaled greyscale image, -1 if the image can't be read
+    import numpy as np
+    from PIL import Image
+    try:
+        with Image.open(path) as im:
+            #Decode JPEG at reduced scale, only a thumbnail is needed
+            im.draft('L', (64, 64))
+            a = np.asarray(im.convert('F').resize((9, 8), Image.Resampling.BOX))
+    except (IOError, ValueError) as e:
+        logger.warning("Cannot hash {}: {}".format(path, str(e)))
+        return -1
+    bits = (a[:, 1:] > a[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0] & 0x7FFFFFFFFFFFFFFF)
+
+def image_hashes(paths, workers=8):
+    """
+    Calculate perceptual (difference) hashes for a list of images
+
+    Parameters
+    ----------
+    paths: list
+        image paths
+    workers: int
+        number of threads
+
+    Returns
+    -------
+    array
+        int64 hash per image, -1 where the image could not be read
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(workers) as pool:
+        return np.array(list(pool.map(_dhash, paths)), dtype=np.int64)
+
+def _hamming(a, b):
+    #Bit differences between two arrays of hashes
+    import numpy as np
+    x = np.bitwise_xor(a, b).astype('<i8').view(np.uint8).reshape(-1, 8)
+    return np.unpackbits(x, axis=1).sum(axis=1)
+
+def _distances(index, i, j):
+    #Distance in metres between rows i and j (equirectangular approximation)
+    import numpy as np
+    R = 6371000.0
+    lat = np.radians(index['lat'])
+    lon = np.radians(index['lon'])
+    dx = (lon[j] - lon[i]) * np.cos((lat[i] + lat[j]) / 2) * R
+    dy = (lat[j] - lat[i]) * R
+    dz = np.nan_to_num(index['alt'][j] - index['alt'][i])
+    return np.sqrt(dx * dx + dy * dy + dz * dz)
+
+def cull_images(index, hash_distance=4, duplicate_spacing=1.0, min_spacing=None, workers=8):
+    """
+    Find near-duplicate and over-dense images that can be left out of an upload
+
+    Images are taken in capture time order. Near-duplicates (eg: hover frames) are images
+    whose perceptual hash is within hash_distance bits of the previous image and were taken
+    less than duplicate_spacing metres away from it (or have no GPS position).
+    If min_spacing is set, only the first image in each min_spacing metres of flight path is kept.
+
+    Parameters
+    ----------
+    index: dict/str
+        image index table from index_images(), or the path of a folder to index
+    hash_distance: int
+        max differing hash bits (of 64) to treat images as near-duplicates
+    duplicate_spacing: float
+        max distance in metres between near-duplicates
+    min_spacing: float
+        min distance in metres along the flight path between kept images, default is no limit
+    workers: int
+        number of threads for hashing
+
+    Returns
+    -------
+    dict
+        "keep": list of images to upload, "duplicates" and "dense": lists of images culled,
+        "bytes_saved": total size of culled images, "bytes_total": total size of all images
+    """
+    import numpy as np
+    if isinstance(index, str):
+        index = index_images(index, workers=workers)
+
+    #Capture order, images without a time stay in path order at the end
+    order = np.argsort(index['time'], kind='stable')
+    index = select_images(index, order)
+    n = len(index['path'])
+    culled_dup = np.zeros(n, dtype=bool)
+    culled_dense = np.zeros(n, dtype=bool)
+
+    if n > 1:
+        hashes = image_hashes(index['path'], workers)
+        close = _hamming(hashes[1:], hashes[:-1]) <= hash_distance
+        close &= (hashes[1:] >= 0) & (hashes[:-1] >= 0)
+        step = _distances(index, np.arange(n - 1), np.arange(1, n))
+        culled_dup[1:] = close & ~(step >= duplicate_spacing)
+
+        if min_spacing:
+            #Keep the first image in each min_spacing bin of distance travelled
+            has_gps = ~np.isnan(index['lat'])
+            travelled = np.concatenate([[0], np.cumsum(np.nan_to_num(step))])
+            bins = np.floor(travelled / min_spacing)
+            first = np.concatenate([[True], bins[1:] != bins[:-1]])
+            culled_dense = has_gps & ~first & ~culled_dup
+
+    keep = ~(culled_dup | culled_dense)
+    result = {
+        "keep": index['path'][keep].tolist(),
+        "duplicates": index['path'][culled_dup].tolist(),
+        "dense": index['path'][culled_dense].tolist(),
+        "bytes_saved": int(index['bytes'][~keep].sum()),
+        "bytes_total": int(index['bytes'].sum()),
+    }
+    print(f"Keeping {keep.sum()} of {n} images, {culled_dup.sum()} near-duplicates, {culled_dense.sum()} over-dense, "
+          f"saves {result['bytes_saved'] / 1e6:.1f} MB of {result['bytes_total'] / 1e6:.1f} MB")
+    return result
+
+def _validate_image(path):
+    #Check a single image, runs in a worker process
+    from PIL import Image
+    errors = []
+    warnings = []
+    try:
+        size = os.path.getsize(path)
+        if size == 0:
+            return {'path': path, 'errors': ["Empty file"], 'warnings': [], 'camera': ''}
+        meta = read_metadata(path)
+        if meta['format'] == 'JPEG':
+            #A complete JPEG ends with the EOI marker (allowing for some padding)
+            with open(path, 'rb') as f:
+                f.seek(max(0, size - 1024))
+                if b'\xff\xd9' not in f.read():
+                    errors += ["Truncated JPEG (no end of image marker)"]
+        if meta['format'] == 'TIFF' and isinstance(meta['bits'], tuple) and meta['bits'] != (8, ) * len(meta['bits']):
+            #Multiband high bit depth, PIL can't decode these
+            try:
+                import tifffile
+                tifffile.imread(path)
+            except (ImportError) as e:
+                warnings += ["Not decoded, multiband images require the tifffile module"]
+        else:
+            with Image.open(path) as im:
+                im.verify()
+            #verify() doesn't decode the image data, load() does
+            with Image.open(path) as im:
+                im.load()
+    except (Exception) as e:
+        errors += ["Cannot decode image: " + str(e)]
+        return {'path': path, 'errors': errors, 'warnings': warnings, 'camera': ''}
+
+    row = _index_row(path)
+    if row['lat'] != row['lat'] or row['lon'] != row['lon']:
+        warnings += ["No GPS position"]
+    elif abs(row['lat']) > 90 or abs(row['lon']) > 180:
+        errors += ["Invalid GPS position: {}, {}".format(row['lat'], row['lon'])]
+    elif row['lat'] == 0 and row['lon'] == 0:
+        #Usually written by cameras without a GPS fix
+        warnings += ["GPS position is 0, 0 (no fix?)"]
+    if row['time'] is None:
+        warnings += ["No capture time"]
+    elif row['time'].year < 2000 or row['time'] > datetime.datetime.now() + datetime.timedelta(days=1):
+        warnings += ["Unlikely capture time: {}".format(row['time'])]
+    return {'path': path, 'errors': errors, 'warnings': warnings, 'camera': (row['make'] + ' ' + row['model']).strip()}
+
+def validate_images(images, workers=None):
+    """
+    Check a set of images before upload, on a pool of processes
+
+    - files are complete and the image data can be decoded
+    - EXIF GPS position and capture time are present and sensible
+    - all images are from the same camera model
+
+    Parameters
+    ----------
+    images: list/str
+        list of image paths, or the path of a folder of images
+    workers: int
+        number of processes, default is the cpu count
+
+    Returns
+    -------
+    dict
+        "valid": False if any image has errors, "images": number of images checked,
+        "errors" and "warnings": dicts of image path: list of messages,
+        "cameras": dict of camera model: number of images
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if isinstance(images, str):
+        images = list_images(images)
+
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(_validate_image, images, chunksize=8))
+
+    report = {"valid": True, "images": len(images), "errors": {}, "warnings": {}, "cameras": {}}
+    for r in results:
+        if r['camera']:
+            report["cameras"][r['camera']] = report["cameras"].get(r['camera'], 0) + 1
+    #Images not from the most common camera
+    if len(report["cameras"]) > 1:
+        main = max(report["cameras"], key=report["cameras"].get)
+        for r in results:
+            if r['camera'] and r['camera'] != main:
+                r['warnings'] += [f"Camera model {r['camera']} differs from the rest of the set ({main})"]
+    for r in results:
+        if len(r['errors']):
+            report["errors"][r['path']] = r['errors']
+            report["valid"] = False
+        if len(r['warnings']):
+            report["warnings"][r['path']] = r['warnings']
+
+    print(f"Checked {len(images)} images, {len(report['errors'])} with errors, {len(report['warnings'])} with warnings")
+    return report
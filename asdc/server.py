@@ -7,13 +7,17 @@ import tornado.ioloop
 import tornado.web
 import tornado.httpclient
 import tornado.httputil
+import tornado.locks
 import sys
 import os
 import re
 from slugify import slugify
 import datetime
+import time
+import asyncio
 import json
-import requests
+import hashlib
+from collections import deque
 
 #Debug logging
 from tornado.log import enable_pretty_logging
@@ -65,9 +69,7 @@ class RootHandler(tornado.web.RequestHandler):
         tokens = self.application.tokens
         if tokens:
             #Show ID token data
-            import jwt
-            id_jwt = tokens.get("id_token")
-            decoded = jwt.decode(id_jwt, options={"verify_signature": False}) # works in PyJWT >= v2.0
+            decoded = self.application.id_claims()
             pic = decoded["picture"]
             self.write(root_doc.format(EXTRA="You are authenticated with the API:<br><pre>" + json.dumps(decoded, indent=2) + f'</pre><img src="{pic}" width="120">'))
         else:
@@ -124,6 +126,7 @@ provider_url = os.getenv('JUPYTER_OAUTH2_AUTH_PROVIDER_URL', '')
 client_id =  os.getenv('JUPYTER_OAUTH2_API_CLIENT_ID', '') #Must use the API client id, not the regular webapp id
 scope = 'openid profile email offline_access' #offline_access scope added for refresh token
 audience = os.getenv('JUPYTER_OAUTH2_API_AUDIENCE', 'https://asdc.cloud.edu.au/api')
+token_prefix = os.getenv('JUPYTER_OAUTH2_PREFIX', 'Bearer') #Authorization header prefix for API requests, as in auth.settings
 state = audience + server + str(int(datetime.datetime.utcnow().timestamp())) # seconds have been converted to integers
 callback_uri = f'{baseurl}{fullurl}asdc/callback'
 
@@ -165,16 +168,140 @@ auth_uri, state = client.create_authorization_url(authorization_endpoint, code_c
 #(Use state to verify later)
 ################################################################################################################
 
-class RequirementsHandler(tornado.web.RequestHandler):
-    def get(self):
-        #Install requirements.txt for a pipeline
-        path = self.get_argument('path')
-        redirect = self.get_argument('next', '/lab/tree/')
+requirements_doc = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8" />
+    <title>Installing requirements</title>
+</head>
+
+<body>
+    <h3>Installing requirements for {PATH}</h3>
+    <pre>
+"""
+
+class RequirementsInstall():
+    """
+    Installs a requirements file, with output kept for all the requests waiting on it
+
+    Wheels are built once into a wheelhouse cached by the requirements hash,
+    then installed from there without downloading anything
+    """
+    def __init__(self, requirements, key):
+        self.requirements = requirements
+        self.wheelhouse = utils.cache_path('requirements', key, 'wheels')
+        self.marker = utils.cache_path('requirements', key, 'installed')
+        self.lines = []
+        self.returncode = None
+        self.changed = tornado.locks.Condition()
+
+    def output(self, line):
+        self.lines.append(line)
+        self.changed.notify_all()
+
+    async def pip(self, *args):
+        import tornado.process
+        import tornado.iostream
+        cmd = [sys.executable, "-m", "pip"] + list(args)
+        self.output("$ " + " ".join(cmd[2:]) + "\n")
+        proc = tornado.process.Subprocess(cmd, stdout=tornado.process.Subprocess.STREAM, stderr=subprocess.STDOUT,
+                                          cwd=os.path.dirname(self.requirements))
+        try:
+            while True:
+                line = await proc.stdout.read_until(b"\n")
+                self.output(line.decode(errors="replace"))
+        except (tornado.iostream.StreamClosedError) as e:
+            pass
+        return await proc.wait_for_exit(raise_error=False)
+
+    async def run(self):
+        complete = os.path.join(self.wheelhouse, '.complete')
+        if not os.path.exists(complete):
+            #Build or download wheels for everything once
+            if await self.pip("wheel", "-r", self.requirements, "-w", self.wheelhouse) == 0:
+                open(complete, 'w').close()
+        if os.path.exists(complete):
+            code = await self.pip("install", "--no-index", "--find-links", self.wheelhouse, "-r", self.requirements)
+        else:
+            code = 1
+        if code != 0:
+            #Fall back to a regular install (eg: requirements that can't be built as wheels)
+            code = await self.pip("install", "-r", self.requirements)
+        if code == 0:
+            open(self.marker, 'w').close()
+        self.returncode = code
+        self.changed.notify_all()
+
+def local_path(url, default):
+    """
+    Only allow same-origin relative paths for redirects, otherwise return default
+    """
+    import urllib.parse
+    #(Browsers ignore tabs/newlines, so "/\t/host" would become "//host")
+    if any(ord(c) < 32 for c in url):
+        return default
+    parts = urllib.parse.urlsplit(url)
+    if not url.startswith('/') or url.startswith('//') or '\\' in url or parts.scheme or parts.netloc:
+        return default
+    return url
 
-        if os.path.exists(Path.home() / path / "requirements.txt"):
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], cwd=str(Path.home() / path))
+class RequirementsHandler(tornado.web.RequestHandler):
+    """
+    Install requirements.txt for a pipeline, then redirect to next
 
-        return self.redirect(redirect)
+    Output is streamed to the page while installing, a repeat request for the same requirements
+    (by file hash) returns straight away, and concurrent requests share one install
+    """
+    async def get(self):
+        path = self.get_argument('path')
+        redirect = local_path(self.get_argument('next', '/lab/tree/'), '/lab/tree/')
+
+        requirements = str(Path.home() / path / "requirements.txt")
+        if not os.path.exists(requirements):
+            return self.redirect(redirect)
+
+        #Key by the file contents and the python environment
+        h = hashlib.sha1(sys.executable.encode())
+        with open(requirements, 'rb') as f:
+            h.update(f.read())
+        key = h.hexdigest()
+        if os.path.exists(utils.cache_path('requirements', key, 'installed')):
+            logger.info(f"Requirements already installed: {requirements}")
+            return self.redirect(redirect)
+
+        install = self.application.installs.get(key)
+        if install is None:
+            install = RequirementsInstall(requirements, key)
+            self.application.installs[key] = install
+            async def run():
+                try:
+                    await install.run()
+                finally:
+                    del self.application.installs[key]
+            asyncio.ensure_future(run())
+
+        import html
+        self.write(requirements_doc.format(PATH=html.escape(path)))
+        await self.flush()
+        sent = 0
+        while True:
+            if sent < len(install.lines):
+                self.write(html.escape("".join(install.lines[sent:])))
+                sent = len(install.lines)
+                await self.flush()
+            elif install.returncode is not None:
+                break
+            else:
+                await install.changed.wait()
+        self.write("</pre>\n")
+        if install.returncode == 0:
+            #(Escape < so the path can't close the script tag)
+            target = json.dumps(redirect).replace("<", "\\u003c")
+            self.write(f'<script>window.location.href = {target};</script>\n')
+        else:
+            self.write(f'<h3>Install failed</h3><a href="{html.escape(redirect)}">Continue</a>\n')
+        self.finish("</body>\n</html>\n")
 
 class RedirectHandler(tornado.web.RequestHandler):
     """
@@ -222,6 +349,7 @@ class ImportHandler(tornado.web.RequestHandler):
         taskname = slugify(self.get_argument('name'))
         asset = self.get_argument('asset', 'orthophoto.tif')
         redirect = self.get_argument('redirect', 'yes')
+        prefetch = self.get_argument('prefetch', 'yes') #yes (selected asset) / all (+ PREFETCH_ASSETS) / no
 
         #Write input data to a file
         destdir = Path.home() / taskname
@@ -240,17 +368,83 @@ class ImportHandler(tornado.web.RequestHandler):
 
         utils.write_inputs(projects=[project], tasks=[task])
 
+        #Start downloading the assets in the background, so they are ready when the notebook runs
+        if prefetch != 'no':
+            assets = [asset]
+            if prefetch == 'all':
+                assets += [a for a in PREFETCH_ASSETS if a != asset]
+            for a in assets:
+                asyncio.ensure_future(self.application.prefetch(project, task, a, str(destdir)))
+
         script = ""
         if redirect == 'yes':
             #script = f'window.location.href="{fullurl}lab/tree/{filename}"'
             return self.redirect(f"{redirected}lab/tree/{taskname}/load.py")
         else:
             #self.write(import_doc.format(FN=filename, script=script))
-            return self.write(import_doc.format(FN=filename, script=""))
+            return self.write(import_doc.format(FN=taskname, script="", redirected=redirected))
+
+#Refresh the tokens this many seconds before they expire
+REFRESH_MARGIN = 300
+#Wait before retrying a failed refresh
+REFRESH_RETRY = 30
+
+#Attempts and initial delay in seconds for token endpoint requests
+TOKEN_RETRIES = 5
+TOKEN_RETRY_DELAY = 0.5
+
+async def token_request(data):
+    """
+    POST to the OAuth2 token endpoint with the async http client, returns the new tokens
+
+    Connection and server errors are retried with jittered exponential backoff,
+    errors in the request itself (eg: an invalid or used code) are raised immediately
+    """
+    import random
+    import urllib.parse
+    token_endpoint = f'{provider_url}/oauth/token'
+    http_client = tornado.httpclient.AsyncHTTPClient()
+    headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "application/json"}
+    for i in range(TOKEN_RETRIES):
+        try:
+            r = await http_client.fetch(token_endpoint, method="POST", headers=headers,
+                                        body=urllib.parse.urlencode(data), request_timeout=30)
+            tokens = json.loads(r.body)
+            if "expires_in" in tokens and not "expires_at" in tokens:
+                tokens["expires_at"] = int(time.time()) + int(tokens["expires_in"])
+            return tokens
+        except (tornado.httpclient.HTTPClientError) as e:
+            #599 is a timeout or connection error
+            if e.code < 500 and e.code != 429:
+                logger.error(f"Token request rejected: {e.code} {e.response.body if e.response else ''}")
+                raise
+            error = e
+        except (OSError) as e:
+            error = e
+        if i < TOKEN_RETRIES-1:
+            delay = TOKEN_RETRY_DELAY * 2**i * random.uniform(0.5, 1.5)
+            logger.info(f"Token request failed: {error}, retry # {i+1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    raise error
+
+async def refresh_tokens(tokens):
+    """
+    Use the refresh_token to get new tokens
+    """
+    rtoken = tokens["refresh_token"]
+    new_tokens = await token_request({
+        "grant_type": "refresh_token",
+        "client_id": client_id,
+        "refresh_token": rtoken
+    })
+    #Keep the refresh token if a new one was not issued
+    if not "refresh_token" in new_tokens:
+        new_tokens["refresh_token"] = rtoken
+    return new_tokens
 
 class TokensHandler(tornado.web.RequestHandler):
-    def get(self):
-        logger.info("Handling tokens")
+    async def get(self):
+        logger.debug("Handling tokens")
         tokens = self.application.tokens
         if not tokens:
             logger.error(f"Tokens are not available")
@@ -259,52 +453,41 @@ class TokensHandler(tornado.web.RequestHandler):
                 reason="Tokens are not available."
             )
 
-        #Return the token data
-        import jwt
-        id_jwt = tokens.get("id_token")
-        decoded = jwt.decode(id_jwt, options={"verify_signature": False}) # works in PyJWT >= v2.0
-        id_token = decoded
-
         #Check if it is expired, renew expired token
-        dt = datetime.datetime.fromtimestamp(tokens['expires_at'])
-        now = datetime.datetime.now(tz=None)
-        if dt <= now:
+        #(Normally already renewed in the background before expiry)
+        if tokens['expires_at'] <= time.time():
             logger.info("Token expired")
-            #Use refresh_token to get new token if necessary
-            token_endpoint = f'{provider_url}/oauth/token'
-            rtoken = tokens["refresh_token"]
-            try:
-                #Need to create new client
-                client = OAuth2SessionProxy(client_id, scope=scope, redirect_uri=callback_uri, audience=audience)
-                new_tokens = client.refresh_token(token_endpoint, refresh_token=rtoken)
-                logger.info(f"New tokens recieved")
-                tokens = new_tokens
-            except (Exception) as e:
-                #Just return the original tokens
-                logger.error(f"Something went wrong: {e}")
-                pass
+            #All requests wait on the same refresh,
+            #just returns the original tokens if this fails
+            await self.application.refresh()
+            tokens = self.application.tokens
 
         self.write(tokens)
 
 class CallbackHandler(tornado.web.RequestHandler):
-    def get(self):
+    async def get(self):
         #NEW HANDLER - Authorization Code Flow with PKCE
-        authorization_response = self.request.uri
         logger.info("/callback")
-        token_endpoint = f'{provider_url}/oauth/token'
-        #This gets the token using auth code flow
-        #THIS SOMETIMES ERRORS WITH http.client.RemoteDisconnected: Remote end closed connection without response
-        #https://github.com/requests/requests-oauthlib/blob/master/requests_oauthlib/oauth2_session.py#L191
-        retries = 5
-        for i in range(retries):
-            try:
-                client = OAuth2SessionProxy(client_id, scope=scope, redirect_uri=callback_uri, audience=audience)
-                tokens = client.fetch_token(token_endpoint, authorization_response=authorization_response, code_verifier=code_verifier, state=state)
-                break
-            except (requests.exceptions.ConnectionError) as e:
-                logger.info(f"Exception in client.fetch_token: {e} retry # {i}")
-                pass
-        self.application.tokens = tokens #Store on application
+        error = self.get_argument('error', None)
+        if error:
+            logger.error(f"Authorization failed: {error}")
+            raise tornado.web.HTTPError(status_code=400, reason=self.get_argument('error_description', error))
+        if self.get_argument('state', None) != state:
+            raise tornado.web.HTTPError(status_code=400, reason="Invalid state")
+
+        #Exchange the code for the tokens, without blocking other requests
+        try:
+            tokens = await token_request({
+                "grant_type": "authorization_code",
+                "client_id": client_id,
+                "code": self.get_argument('code'),
+                "redirect_uri": callback_uri,
+                "code_verifier": code_verifier
+            })
+        except (Exception) as e:
+            logger.error(f"Token exchange failed: {e}")
+            raise tornado.web.HTTPError(status_code=502, reason="Token exchange with the auth provider failed")
+        self.application.set_tokens(tokens) #Store on application
 
         #Re-write the input data, now include the server port to access tokens with
         utils.write_port(sys.argv[1])
@@ -316,25 +499,434 @@ class CallbackHandler(tornado.web.RequestHandler):
             logger.info(f"Redirecting: {self.application.redirect_path}")
             return self.redirect(self.application.redirect_path)
 
+#Local caching proxy for the WebODM API
+#Asset downloads are kept on disk for this many seconds
+PROXY_TTL = 3600
+#Only these API paths are kept in the disk cache, other GET requests are just coalesced
+PROXY_CACHED = re.compile(r'^projects/\d+/tasks/[^/]+/(download|assets|images/download)/')
+PROXY_BLOCK = 262144
+#Maximum disk cache size in bytes, oldest entries are removed first
+PROXY_CACHE_MAX = int(os.getenv('ASDC_PROXY_CACHE_MAX', 20 * 2**30))
+#Seconds between disk cache sweeps
+PROXY_SWEEP = 600
+#Partial downloads not written to for this many seconds are abandoned
+PROXY_PART_STALE = 600
+PROXY_HEADERS = ["Content-Type", "Content-Length", "Content-Disposition", "ETag", "Last-Modified"]
+
+#Other assets downloaded by /import when prefetch=all
+PREFETCH_ASSETS = ["orthophoto.tif", "dsm.tif", "georeferenced_model.laz"]
+#Minimum seconds between prefetch progress file updates
+PREFETCH_UPDATE = 0.5
+
+class ProxyFetch():
+    """
+    A single upstream request, shared by all the clients requesting the same url
+
+    The response body is written to a file as it arrives, readers stream from the file
+    and wait for more data until the request is done
+    """
+    def __init__(self, url, path=None, cache=True):
+        self.url = url
+        self.path = path #File to keep the response in, if any
+        self.cache = cache #Write cache metadata for the kept file
+        self.part = (path or utils.cache_path('proxy', 'tmp', hashlib.sha1(url.encode()).hexdigest())) + f'.{os.getpid()}.part'
+        self.file = open(self.part, 'wb')
+        self.size = 0
+        self.code = None
+        self.headers = tornado.httputil.HTTPHeaders()
+        self.error = None
+        self.done = False
+        self.ready = tornado.locks.Event() #Status and headers available
+        self.changed = tornado.locks.Condition() #More data or done
+
+    def header(self, line):
+        #(Headers are reset for each response when following redirects)
+        if line.startswith("HTTP/"):
+            self.headers = tornado.httputil.HTTPHeaders()
+            self.code = int(line.split()[1])
+        elif line.strip():
+            self.headers.parse_line(line)
+
+    def data(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        self.file.flush()
+        self.ready.set()
+        self.changed.notify_all()
+
+    async def run(self, http_client, token):
+        try:
+            r = await http_client.fetch(self.url, headers={"Authorization": token_prefix + " " + token},
+                                        header_callback=self.header, streaming_callback=self.data,
+                                        connect_timeout=30, request_timeout=3600, raise_error=False)
+            self.code = r.code
+            if r.code == 599:
+                self.error = r.error
+        except (Exception) as e:
+            self.error = e
+        self.file.close()
+        if self.path and self.error is None and self.code == 200:
+            os.replace(self.part, self.path)
+            if self.cache:
+                meta = {"url": self.url, "time": time.time(),
+                        "headers": {k: self.headers[k] for k in PROXY_HEADERS if k in self.headers}}
+                with open(self.part + '.json', 'w') as f:
+                    json.dump(meta, f)
+                os.replace(self.part + '.json', self.path + '.json')
+        else:
+            #(Readers already have the file open)
+            os.remove(self.part)
+        self.done = True
+        self.ready.set()
+        self.changed.notify_all()
+
+class ProxyHandler(tornado.web.RequestHandler):
+    """
+    Caching proxy for WebODM API GET requests, shared by all the user's kernels
+
+    - Requires the same access token the server provides to clients
+    - Concurrent requests for the same url share one upstream request
+    - Asset downloads are kept in a disk cache for PROXY_TTL seconds
+    """
+    async def get(self, path):
+        tokens = self.application.tokens
+        if not tokens:
+            raise tornado.web.HTTPError(status_code=404, reason="Tokens are not available.")
+        import hmac
+        token = self.request.headers.get("Authorization", "").split(" ")[-1]
+        if not any(hmac.compare_digest(token, t) for t in self.application.recent_tokens):
+            raise tornado.web.HTTPError(status_code=403, reason="Invalid token")
+
+        url = audience + '/' + path
+        if self.request.query:
+            url += '?' + self.request.query
+        cached = self.application.proxy_cached(url)
+        if cached:
+            logger.info(f"Proxy cache hit: {url}")
+            return await self.send(*cached)
+
+        fetch = await self.application.proxy_fetch(url)
+        f = open(fetch.part, 'rb')
+        await fetch.ready.wait()
+        if fetch.code is None or fetch.code == 599:
+            f.close()
+            logger.error(f"Proxy request failed: {url} {fetch.error}")
+            raise tornado.web.HTTPError(status_code=502, reason="Upstream request failed")
+        self.set_status(fetch.code)
+        await self.send(f, fetch.headers, fetch)
+
+    async def send(self, f, headers, fetch=None):
+        #Stream the file, waiting for more data while the fetch is in progress
+        for k in PROXY_HEADERS:
+            if k in headers:
+                self.set_header(k, headers[k])
+        with f:
+            while True:
+                chunk = f.read(PROXY_BLOCK)
+                if chunk:
+                    self.write(chunk)
+                    await self.flush()
+                elif fetch is None or fetch.done:
+                    break
+                else:
+                    await fetch.changed.wait()
+        #Incomplete, close the connection so the client sees the error
+        if fetch is not None and fetch.error is not None:
+            self.request.connection.close()
+            return
+        self.finish()
+
 class ServerApplication(tornado.web.Application):
 
     def __init__(self):
         self.redirect_path = "/";
         self.tokens = {};
+        self.refresh_timeout = None
+        self.refreshing = None #Refresh in progress
+        self.claims = (None, None) #Decoded id_token claims, (id_token, claims)
+        self.refresh_latency = deque(maxlen=100) #Recent (time, seconds taken) for each refresh
+        self.recent_tokens = deque(maxlen=2) #Access tokens accepted by the proxy (current and previous)
+        self.proxy_requests = {} #Proxy requests in progress by url
+        self.prefetching = set() #Background asset downloads in progress
+        self.installs = {} #Requirements installs in progress by hash
+        self._proxy_client = None
 
         handlers = [
             (r"/", RootHandler),
             (r"/redirect", RedirectHandler),
             (r"/import", ImportHandler),
+            (r"/requirements", RequirementsHandler),
             (r"/tokens", TokensHandler),
-            (r"/callback", CallbackHandler)
+            (r"/callback", CallbackHandler),
+            (r"/cache/(.*)", ProxyHandler)
         ]
         settings = dict() #your application settings here
         super().__init__(handlers, **settings)
 
+    def set_tokens(self, tokens):
+        """
+        Store new tokens, share them with the kernels and schedule the next refresh
+        """
+        self.tokens = tokens
+        if "access_token" in tokens:
+            self.recent_tokens.append(tokens["access_token"])
+        #Share the access token with kernels and worker processes
+        utils.write_token_cache(tokens)
+        if "expires_at" in tokens and "refresh_token" in tokens:
+            self.schedule_refresh(tokens["expires_at"] - REFRESH_MARGIN - time.time())
+
+    def schedule_refresh(self, delay):
+        ioloop = tornado.ioloop.IOLoop.current()
+        if self.refresh_timeout is not None:
+            ioloop.remove_timeout(self.refresh_timeout)
+        self.refresh_timeout = ioloop.call_later(max(0, delay), self.refresh)
+
+    def proxy_cached(self, url):
+        """
+        Get the proxy disk cache file for a url, if it is kept and has not expired
+
+        Returns
+        -------
+        tuple
+            (open file, headers dict) or None
+        """
+        path = url[len(audience)+1:]
+        if not PROXY_CACHED.match(path):
+            return None
+        cachefile = utils.cache_path('proxy', hashlib.sha1(url.encode()).hexdigest())
+        try:
+            with open(cachefile + '.json', 'r') as f:
+                meta = json.load(f)
+            if meta["time"] + PROXY_TTL > time.time():
+                return open(cachefile, 'rb'), meta["headers"]
+        except (OSError, ValueError, KeyError) as e:
+            pass
+        return None
+
+    async def proxy_fetch(self, url, dest=None):
+        """
+        Join the proxy request in progress for a url, or start a new one
+
+        The fetch file must be opened before awaiting anything else,
+        as it is moved or removed when the request is done
+
+        Parameters
+        ----------
+        url: str
+            full API url
+        dest: str
+            file to write a new request to, instead of the disk cache
+        """
+        fetch = self.proxy_requests.get(url)
+        if fetch is not None:
+            logger.info(f"Proxy joined request in progress: {url}")
+            return fetch
+        if self.tokens['expires_at'] <= time.time():
+            await self.refresh()
+            #Another request may have started while waiting
+            if url in self.proxy_requests:
+                return self.proxy_requests[url]
+        path = url[len(audience)+1:]
+        cachefile = utils.cache_path('proxy', hashlib.sha1(url.encode()).hexdigest()) if PROXY_CACHED.match(path) and not dest else None
+        fetch = ProxyFetch(url, dest or cachefile, cache=dest is None)
+        self.proxy_requests[url] = fetch
+        async def run():
+            try:
+                await fetch.run(self.proxy_client(), self.tokens["access_token"])
+            finally:
+                del self.proxy_requests[url]
+            if cachefile:
+                #Keep the cache within the size limit
+                self.sweep_proxy_cache()
+        asyncio.ensure_future(run())
+        return fetch
+
+    def sweep_proxy_cache(self):
+        """
+        Remove expired proxy cache entries and abandoned partial downloads,
+        then the oldest entries until the cache is under PROXY_CACHE_MAX bytes
+
+        Run at startup, every PROXY_SWEEP seconds and when a cached download completes,
+        files already opened by readers remain readable until closed
+        """
+        now = time.time()
+        active = set(fetch.part for fetch in self.proxy_requests.values())
+        entries = []
+        for root in [utils.cache_path('proxy'), utils.cache_path('proxy', 'tmp')]:
+            #(Not created until something is cached)
+            os.makedirs(root, exist_ok=True)
+            for entry in os.scandir(root):
+                if not entry.is_file():
+                    continue
+                try:
+                    #Partial downloads: ours are abandoned when no longer in progress,
+                    #other processes' when they have not been written to recently
+                    if entry.name.endswith('.part') or entry.name.endswith('.part.json'):
+                        ours = entry.name.split('.part')[0].rsplit('.', 1)[-1] == str(os.getpid())
+                        if entry.path.replace('.part.json', '.part') in active:
+                            continue
+                        if ours or entry.stat().st_mtime + PROXY_PART_STALE < now:
+                            os.remove(entry.path)
+                        continue
+                    if root != utils.cache_path('proxy') or entry.name.endswith('.json'):
+                        continue
+                    try:
+                        with open(entry.path + '.json', 'r') as f:
+                            cached = json.load(f)["time"]
+                    except (OSError, ValueError, KeyError) as e:
+                        #No metadata, removed once it would have expired
+                        cached = entry.stat().st_mtime
+                    if cached + PROXY_TTL <= now:
+                        self.remove_proxy_cached(entry.path)
+                    else:
+                        entries.append((cached, entry.stat().st_size, entry.path))
+                except (OSError) as e:
+                    #Removed by another request
+                    pass
+        #Orphaned metadata
+        for entry in os.scandir(utils.cache_path('proxy')):
+            if entry.name.endswith('.json') and not entry.name.endswith('.part.json') and not os.path.exists(entry.path[:-5]):
+                self.remove_proxy_cached(entry.path[:-5])
+        total = sum(e[1] for e in entries)
+        for cached, size, path in sorted(entries):
+            if total <= PROXY_CACHE_MAX:
+                break
+            logger.info(f"Proxy cache full, removing: {path}")
+            self.remove_proxy_cached(path)
+            total -= size
+
+    def remove_proxy_cached(self, path):
+        for f in [path + '.json', path]:
+            try:
+                os.remove(f)
+            except (FileNotFoundError) as e:
+                pass
+
+    async def prefetch(self, project, task, filename, destdir):
+        """
+        Download a task asset into destdir in the background
+
+        The file is written straight to destdir and not kept in the proxy disk cache,
+        kernels requesting the same url meanwhile share the download.
+        If the url is already being fetched through the proxy, that download is copied instead.
+        The file is written to a .part file then renamed when complete,
+        progress is written for download_asset() to wait on, see utils.read_prefetch_progress()
+        """
+        dest = os.path.join(destdir, filename)
+        if os.path.exists(dest) or dest in self.prefetching:
+            return
+        self.prefetching.add(dest)
+        url = f"{audience}/projects/{project}/tasks/{task}/download/{filename}"
+        progress = {"url": url, "status": "downloading", "bytes": 0, "total": None}
+        utils.write_prefetch_progress(dest, progress)
+        logger.info(f"Prefetching: {url}")
+        part = dest + '.part'
+        try:
+            fetch = await self.proxy_fetch(url, dest)
+            #Started here, the fetch writes dest itself
+            direct = fetch.path == dest
+            src = None if direct else open(fetch.part, 'rb')
+            await fetch.ready.wait()
+            if fetch.code != 200:
+                if src:
+                    src.close()
+                raise(Exception(f"Response {fetch.code} {fetch.error or ''}"))
+            if "Content-Length" in fetch.headers:
+                progress["total"] = int(fetch.headers["Content-Length"])
+            updated = 0
+            if direct:
+                while not fetch.done:
+                    progress["bytes"] = fetch.size
+                    if time.time() - updated > PREFETCH_UPDATE:
+                        utils.write_prefetch_progress(dest, progress)
+                        updated = time.time()
+                    await fetch.changed.wait()
+                progress["bytes"] = fetch.size
+            else:
+                with src, open(part, 'wb') as out:
+                    while True:
+                        chunk = src.read(PROXY_BLOCK)
+                        if chunk:
+                            out.write(chunk)
+                            progress["bytes"] += len(chunk)
+                            if time.time() - updated > PREFETCH_UPDATE:
+                                utils.write_prefetch_progress(dest, progress)
+                                updated = time.time()
+                            #Let other requests run
+                            await asyncio.sleep(0)
+                        elif fetch.done:
+                            break
+                        else:
+                            await fetch.changed.wait()
+            if fetch.error is not None:
+                raise(Exception(str(fetch.error)))
+            if not direct:
+                os.replace(part, dest)
+            progress["status"] = "done"
+            logger.info(f"Prefetch complete: {dest}")
+        except (Exception) as e:
+            logger.error(f"Prefetch failed: {url} {e}")
+            progress["status"] = "error"
+            progress["error"] = str(e)
+            if os.path.exists(part):
+                os.remove(part)
+        finally:
+            self.prefetching.discard(dest)
+        utils.write_prefetch_progress(dest, progress)
+
+    def proxy_client(self):
+        #Separate client for the proxy, allowing many large downloads at once
+        if self._proxy_client is None:
+            self._proxy_client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=50,
+                                                                     max_body_size=1 << 50)
+        return self._proxy_client
+
+    def id_claims(self):
+        """
+        Get the decoded id_token claims, only decoded again when the token changes
+        """
+        id_jwt = self.tokens.get("id_token")
+        if id_jwt != self.claims[0]:
+            import jwt
+            decoded = jwt.decode(id_jwt, options={"verify_signature": False}) # works in PyJWT >= v2.0
+            self.claims = (id_jwt, decoded)
+        return self.claims[1]
+
+    async def refresh(self):
+        """
+        Renew the tokens, if a refresh is already in progress, wait for that one
+        """
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self._refresh())
+            def done(future):
+                self.refreshing = None
+            self.refreshing.add_done_callback(done)
+        await asyncio.shield(self.refreshing)
+
+    async def _refresh(self):
+        if not "refresh_token" in self.tokens:
+            return
+        start = time.time()
+        try:
+            tokens = await refresh_tokens(self.tokens)
+        except (Exception) as e:
+            logger.error(f"Token refresh failed: {e}")
+            self.schedule_refresh(REFRESH_RETRY)
+            return
+        elapsed = time.time() - start
+        self.refresh_latency.append((start, elapsed))
+        logger.info(f"New tokens recieved, refresh took {elapsed:.3f}s")
+        self.set_tokens(tokens)
+
 if __name__ == "__main__":
     print("Starting OAuth2 callback server", sys.argv)
     app = ServerApplication()
-    app.listen(sys.argv[1])
+    http_server = app.listen(sys.argv[1])
+    #Clear out the proxy disk cache now and periodically
+    app.sweep_proxy_cache()
+    tornado.ioloop.PeriodicCallback(app.sweep_proxy_cache, PROXY_SWEEP * 1000).start()
+    #Also listen on a unix domain socket, only accessible by the user
+    import tornado.netutil
+    http_server.add_socket(tornado.netutil.bind_unix_socket(utils.server_socket_path(), mode=0o600))
     tornado.ioloop.IOLoop.current().start()
 
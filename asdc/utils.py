@@ -10,10 +10,13 @@ logger = logging.getLogger('app.logger')
 import json
 import re
 import os
-from PIL import Image
-import piexif
-
+import io
+import functools
+import shutil
+import zipfile
+import time
 import sys
+
 class ExecutionPaused(Exception):
     """Pause Execution Exception for IPython.
 
@@ -61,95 +64,729 @@ def is_notebook():
     # check for `kernel` attribute on the IPython instance
     return getattr(get_ipython(), 'kernel', None) is not None
 
-def resize_image(image_path, resize_to, done=None):
+def _read_jpeg_header(f):
+    #Read the JPEG marker segments up to the start of scan, the image data is not read
+    meta = {'format': 'JPEG', 'size': None, 'bits': None, 'exif': None, 'xmp': None}
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG file")
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        code = marker[1]
+        if code == 0xD9 or code == 0xDA:
+            #End of image / start of scan
+            break
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            #No length
+            continue
+        length = int.from_bytes(f.read(2), 'big') - 2
+        #APP1 holds EXIF or XMP (in any order, eg: drone images have XMP after EXIF)
+        if code == 0xE1 and (meta['exif'] is None or meta['xmp'] is None) or code in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            data = f.read(length)
+        else:
+            f.seek(length, os.SEEK_CUR)
+            continue
+        if code == 0xE1:
+            if data.startswith(b'Exif\x00\x00') and meta['exif'] is None:
+                meta['exif'] = data
+            elif data.startswith(b'http://ns.adobe.com/xap/1.0/\x00') and meta['xmp'] is None:
+                meta['xmp'] = data[29:]
+        else:
+            #Start of frame: precision, height, width, components
+            height = int.from_bytes(data[1:3], 'big')
+            width = int.from_bytes(data[3:5], 'big')
+            meta['size'] = (width, height)
+            meta['bits'] = data[0] if data[5] == 1 else (data[0], ) * data[5]
+    return meta
+
+def _read_tiff_header(f):
+    #Read the tags needed from the first IFD of a TIFF (PIL can't open all multiband TIFFs)
+    meta = {'format': 'TIFF', 'size': None, 'bits': None, 'exif': None, 'xmp': None}
+    order = 'little' if f.read(2) == b'II' else 'big'
+    if int.from_bytes(f.read(2), order) != 42:
+        raise ValueError("Not a classic TIFF file")
+    f.seek(int.from_bytes(f.read(4), order))
+    entries = f.read(12 * int.from_bytes(f.read(2), order))
+    #Field type sizes: BYTE, ASCII, SHORT, LONG, RATIONAL, SBYTE, UNDEFINED
+    sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1}
+    tags = {}
+    for i in range(0, len(entries), 12):
+        tag = int.from_bytes(entries[i:i+2], order)
+        if tag not in (256, 257, 258, 700):
+            continue
+        ftype = int.from_bytes(entries[i+2:i+4], order)
+        count = int.from_bytes(entries[i+4:i+8], order)
+        nbytes = sizes.get(ftype, 1) * count
+        data = entries[i+8:i+12]
+        if nbytes > 4:
+            pos = f.tell()
+            f.seek(int.from_bytes(data, order))
+            data = f.read(nbytes)
+            f.seek(pos)
+        if ftype in (3, 4):
+            step = sizes[ftype]
+            tags[tag] = tuple(int.from_bytes(data[j:j+step], order) for j in range(0, nbytes, step))
+        else:
+            tags[tag] = data[:nbytes]
+    if 256 in tags and 257 in tags:
+        meta['size'] = (tags[256][0], tags[257][0])
+    bps = tags.get(258)
+    if bps:
+        meta['bits'] = bps[0] if len(bps) == 1 else bps
+    meta['xmp'] = tags.get(700)
+    return meta
+
+@functools.lru_cache(maxsize=4096)
+def _read_metadata(image_path, mtime, size):
+    with open(image_path, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic[:2] == b'\xff\xd8':
+            return _read_jpeg_header(f)
+        if magic in (b'II*\x00', b'MM\x00*'):
+            return _read_tiff_header(f)
+    #Other formats, PIL only reads the header on open
+    from PIL import Image
+    with Image.open(image_path) as im:
+        return {'format': im.format, 'size': im.size, 'bits': None, 'exif': im.info.get('exif'), 'xmp': None}
+
+def read_metadata(image_path):
     """
-    Provides the image_resize function from WebODM:
-    https://github.com/OpenDroneMap/WebODM/blob/master/app/models/task.py
-    https://github.com/OpenDroneMap/WebODM/blob/master/LICENSE.md
+    Read image metadata from the file header only, results are cached
+    (until the file is modified) so the rest of a pipeline can reuse them
+
+    :param image_path: path to the image
+    :return: dict with format, size (width, height), bits (BitsPerSample, int for single band),
+             exif (raw EXIF segment bytes, as in PIL Image.info['exif'], None for TIFF
+             where the EXIF tags are the TIFF tags) and xmp (bytes)
+    """
+    st = os.stat(image_path)
+    return _read_metadata(image_path, st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=4096)
+def _read_exif(image_path, mtime, size):
+    import piexif
+    meta = _read_metadata(image_path, mtime, size)
+    if meta['exif']:
+        return piexif.load(meta['exif'])
+    if meta['format'] == 'TIFF':
+        #Tags are usually at the start of the file, try the header bytes first
+        #(piexif.load would read the whole file)
+        with open(image_path, 'rb') as f:
+            header = f.read(65536)
+        try:
+            return piexif.load(header)
+        except (Exception) as e:
+            return piexif.load(image_path)
+    return {'0th': {}, 'Exif': {}, 'GPS': {}, 'Interop': {}, '1st': {}, 'thumbnail': None}
+
+def read_exif(image_path):
+    """
+    Get the parsed EXIF data for an image (piexif dict format),
+    parsed once from the header read by read_metadata() and cached
+
+    :param image_path: path to the image
+    :return: dict of EXIF IFDs, eg: exif['GPS'][piexif.GPSIFD.GPSLatitude]
+    """
+    st = os.stat(image_path)
+    return _read_exif(image_path, st.st_mtime_ns, st.st_size)
+
+#PIL modes with more than 8 bits per sample, these are resized as NumPy arrays to keep the bit depth
+HIGH_DEPTH_MODES = ['I;16', 'I;16L', 'I;16B', 'I;16N', 'I', 'F']
+#TIFF tags describing the image layout, must not be copied to a resized image
+TIFF_LAYOUT_TAGS = [256, 257, 273, 278, 279, 322, 323, 324, 325]
+#Descriptive TIFF tags copied to resized multiband images (700 is XMP),
+#270 (ImageDescription) is not copied when it holds tifffile's array shape
+TIFF_COPY_TAGS = [269, 270, 271, 272, 306, 315, 700, 33432]
+#EXIF and GPSInfo sub-IFDs, these can't be written with tifffile,
+#multiband images that have them are not resized so the GPS position is never lost
+TIFF_IFD_TAGS = [34665, 34853]
+
+def _resample_weights(in_size, out_size, method='area'):
+    #Weights matrix (out_size x in_size) to resample one axis
+    import numpy as np
+    scale = in_size / out_size
+    if method == 'area':
+        #Fraction of each input pixel covered by each output pixel
+        start = np.arange(out_size)[:, None] * scale
+        j = np.arange(in_size)[None, :]
+        w = np.clip(np.minimum(start + scale, j + 1) - np.maximum(start, j), 0, None)
+    elif method == 'lanczos':
+        #Lanczos-3, widened by the scale when downsampling
+        a = 3.0
+        support = max(scale, 1.0)
+        centre = (np.arange(out_size)[:, None] + 0.5) * scale - 0.5
+        x = (np.arange(in_size)[None, :] - centre) / support
+        w = np.where(np.abs(x) < a, np.sinc(x) * np.sinc(x / a), 0)
+    else:
+        raise ValueError("Unknown resize method: " + method)
+    return (w / w.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def resize_array(arr, size, method='area'):
+    """
+    Resize an image array of any dtype with NumPy, the dtype is kept
+
+    :param arr: image array, (rows, columns) or (rows, columns, bands)
+    :param size: (width, height) to resize to
+    :param method: 'area' (area averaging, best for downscaling) or 'lanczos'
+    :return: resized array
+    """
+    import numpy as np
+    width, height = size
+    wy = _resample_weights(arr.shape[0], height, method)
+    wx = _resample_weights(arr.shape[1], width, method)
+    out = np.tensordot(wy, arr.astype(np.float32), axes=(1, 0))
+    out = np.moveaxis(np.tensordot(out, wx, axes=(1, 1)), -1, 1)
+    if np.issubdtype(arr.dtype, np.integer):
+        info = np.iinfo(arr.dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(arr.dtype)
+
+def _resize_multiband(image_path, resize_to, method='area'):
+    #Multiband images with more than 8 bits per sample can't be opened with PIL,
+    #read and write with tifffile instead
+    import numpy as np
+    try:
+        import tifffile
+    except (ImportError) as e:
+        logger.warning("Cannot resize %s, multiband images require the tifffile module" % image_path)
+        return {'path': image_path, 'resize_ratio': 1, 'data': None}
+
+    with tifffile.TiffFile(image_path) as tif:
+        page = tif.pages[0]
+        if any(t in page.tags for t in TIFF_IFD_TAGS):
+            logger.warning("Not resizing {}, the EXIF/GPS tags of multiband images can't be copied".format(image_path))
+            return {'path': image_path, 'resize_ratio': 1, 'data': None}
+        #Move rows, columns to the front for resize_array
+        yx = [page.axes.index('Y'), page.axes.index('X')]
+        arr = np.moveaxis(page.asarray(), yx, [0, 1])
+        height, width = arr.shape[:2]
+        max_side = max(width, height)
+        if max_side < resize_to:
+            logger.warning('You asked to make {} bigger ({} --> {}), but we are not going to do that.'.format(image_path, max_side, resize_to))
+            return {'path': image_path, 'resize_ratio': 1, 'data': None}
+
+        ratio = float(resize_to) / float(max_side)
+        resized_width = int(width * ratio)
+        resized_height = int(height * ratio)
+        resized = np.moveaxis(resize_array(arr, (resized_width, resized_height), method), [0, 1], yx)
+
+        #XMP holds most of the camera and band metadata
+        extratags = [(t.code, t.dtype, t.count, t.value, True) for t in page.tags.values() if t.code in TIFF_COPY_TAGS
+                     and not (t.code == 270 and str(t.value).startswith('{"shape":'))]
+        data = io.BytesIO()
+        tifffile.imwrite(data, resized, photometric=page.photometric, planarconfig=page.planarconfig,
+                         extrasamples=page.extrasamples or None, extratags=extratags, metadata=None)
+        data.seek(0)
+
+    logger.info("Resized {} to {}x{}".format(image_path, resized_width, resized_height))
+    return {'path': image_path, 'resize_ratio': ratio, 'data': data}
+
+def resize_image_data(image_path, resize_to, fast=False, method='area'):
+    """
+    Resize an image in memory, the original file is left untouched
+    (EXIF data is kept in the resized image)
+
+    Images with more than 8 bits per sample (eg: multispectral 16bit) are resized
+    as NumPy arrays to keep the bit depth, multiband images of this type require tifffile
 
     :param image_path: path to the image
     :param resize_to: target size to resize this image to (largest side)
-    :param done: optional callback
-    :return: path and resize ratio
+    :param fast: trade some quality for speed, JPEGs are decoded at reduced scale
+                 (DCT scaling) close to the target size, and large downscales are
+                 reduced by integer factors before the final LANCZOS resample
+    :param method: filter for NumPy resizing of high bit depth images, 'area' or 'lanczos'
+    :return: dict with path, resize ratio and data (BytesIO with the encoded image,
+             or None if the image was not resized), None on error
     """
+    from PIL import Image
     try:
         can_resize = False
 
-        # Check if this image can be resized
-        # There's no easy way to resize multispectral 16bit images
-        # (Support should be added to PIL)
+        # Check if this image can be resized with PIL
         is_jpeg = re.match(r'.*\.jpe?g$', image_path, re.IGNORECASE)
 
+        meta = read_metadata(image_path)
         if is_jpeg:
             # We can always resize these
             can_resize = True
         else:
-            try:
-                bps = piexif.load(image_path)['0th'][piexif.ImageIFD.BitsPerSample]
+            bps = meta['bits']
+            if bps is None:
+                logger.warning("Cannot find BitsPerSample tag for %s" % image_path)
+            else:
                 if isinstance(bps, int):
                     # Always resize single band images
                     can_resize = True
                 elif isinstance(bps, tuple) and len(bps) > 1:
-                    # Only resize multiband images if depth is 8bit
+                    # Only multiband images with 8bit depth can be opened by PIL
                     can_resize = bps == (8, ) * len(bps)
                 else:
                     logger.warning("Cannot determine if image %s can be resized, hoping for the best!" % image_path)
                     can_resize = True
-            except KeyError:
-                logger.warning("Cannot find BitsPerSample tag for %s" % image_path)
 
         if not can_resize:
+            if isinstance(meta['bits'], tuple):
+                return _resize_multiband(image_path, resize_to, method)
             logger.warning("Cannot resize %s" % image_path)
-            return {'path': image_path, 'resize_ratio': 1}
-
-        im = Image.open(image_path)
-        path, ext = os.path.splitext(image_path)
-        resized_image_path = os.path.join(path + '.resized' + ext)
+            return {'path': image_path, 'resize_ratio': 1, 'data': None}
+
+        with Image.open(image_path) as im:
+            width, height = im.size
+            max_side = max(width, height)
+            if max_side < resize_to:
+                logger.warning('You asked to make {} bigger ({} --> {}), but we are not going to do that.'.format(image_path, max_side, resize_to))
+                return {'path': image_path, 'resize_ratio': 1, 'data': None}
+
+            ratio = float(resize_to) / float(max_side)
+            resized_width = int(width * ratio)
+            resized_height = int(height * ratio)
+
+            if im.mode in HIGH_DEPTH_MODES:
+                #Resize the array to keep the bit depth, PIL only filters these at 8 bits or as 32 bit int/float
+                import numpy as np
+                resized = Image.fromarray(resize_array(np.asarray(im), (resized_width, resized_height), method))
+                #TIFF tags are stored with the EXIF, drop the ones describing the original layout
+                exif = im.getexif()
+                for tag in TIFF_LAYOUT_TAGS:
+                    exif.pop(tag, None)
+                data = io.BytesIO()
+                resized.save(data, format=im.format, exif=exif)
+                data.seek(0)
+                logger.info("Resized {} to {}x{}".format(image_path, resized_width, resized_height))
+                return {'path': image_path, 'resize_ratio': ratio, 'data': data}
+
+            if fast:
+                #Only has an effect on JPEG, decoder scales by 1/2, 1/4 or 1/8 to no smaller than the target
+                im.draft(im.mode, (resized_width, resized_height))
+                resized = im.resize((resized_width, resized_height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+            else:
+                resized = im.resize((resized_width, resized_height), Image.Resampling.LANCZOS)
+            params = {}
+            if is_jpeg:
+                params['quality'] = 100
+
+            data = io.BytesIO()
+            if meta['exif']:
+                #Raw EXIF segment from the header, written back as-is
+                resized.save(data, format=im.format, exif=meta['exif'], **params)
+            else:
+                resized.save(data, format=im.format, **params)
+            data.seek(0)
 
-        width, height = im.size
-        max_side = max(width, height)
-        if max_side < resize_to:
-            logger.warning('You asked to make {} bigger ({} --> {}), but we are not going to do that.'.format(image_path, max_side, resize_to))
-            im.close()
-            return {'path': image_path, 'resize_ratio': 1}
+        logger.info("Resized {} to {}x{}".format(image_path, resized_width, resized_height))
+    except (IOError, ValueError) as e:
+        logger.warning("Cannot resize {}: {}.".format(image_path, str(e)))
+        return None
 
-        ratio = float(resize_to) / float(max_side)
-        resized_width = int(width * ratio)
-        resized_height = int(height * ratio)
+    return {'path': image_path, 'resize_ratio': ratio, 'data': data}
 
-        im = im.resize((resized_width, resized_height), Image.Resampling.LANCZOS)
-        params = {}
-        if is_jpeg:
-            params['quality'] = 100
+def resize_image(image_path, resize_to, done=None, fast=False, method='area'):
+    """
+    Provides the image_resize function from WebODM:
+    https://github.com/OpenDroneMap/WebODM/blob/master/app/models/task.py
+    https://github.com/OpenDroneMap/WebODM/blob/master/LICENSE.md
 
-        if 'exif' in im.info:
-            exif_dict = piexif.load(im.info['exif'])
-            #exif_dict['Exif'][piexif.ExifIFD.PixelXDimension] = resized_width
-            #exif_dict['Exif'][piexif.ExifIFD.PixelYDimension] = resized_height
-            im.save(resized_image_path, exif=piexif.dump(exif_dict), **params)
-        else:
-            im.save(resized_image_path, **params)
+    The resized image replaces the original, use resize_image_data()
+    to resize in memory without modifying the original
 
-        im.close()
+    :param image_path: path to the image
+    :param resize_to: target size to resize this image to (largest side)
+    :param done: optional callback
+    :param fast: faster, lower quality resize, see resize_image_data()
+    :param method: filter for high bit depth images, see resize_image_data()
+    :return: path and resize ratio
+    """
+    retval = resize_image_data(image_path, resize_to, fast, method)
+    if retval is None:
+        if done is not None:
+            done()
+        return None
 
-        # Delete original image, rename resized image to original
-        os.remove(image_path)
-        os.rename(resized_image_path, image_path)
+    data = retval.pop('data')
+    if data is None:
+        return retval
 
-        logger.info("Resized {} to {}x{}".format(image_path, resized_width, resized_height))
-    except (IOError, ValueError) as e:
+    try:
+        # Write resized image alongside, then replace the original
+        path, ext = os.path.splitext(image_path)
+        resized_image_path = os.path.join(path + '.resized' + ext)
+        with open(resized_image_path, 'wb') as f:
+            shutil.copyfileobj(data, f)
+        os.replace(resized_image_path, image_path)
+    except (IOError) as e:
         logger.warning("Cannot resize {}: {}.".format(image_path, str(e)))
         if done is not None:
             done()
         return None
 
-    retval = {'path': image_path, 'resize_ratio': ratio}
-
     if done is not None:
         done(retval)
 
     return retval
 
+def resize_images(image_paths, resize_to, workers=None, queue_size=None, done=None, fast=False):
+    """
+    Resize a batch of images with resize_image(), spread over a process pool
+    (the resized images replace the originals)
+
+    Only queue_size images are queued on the pool at any time to limit memory use
+
+    :param image_paths: list of paths to the images
+    :param resize_to: target size to resize the images to (largest side)
+    :param workers: number of processes, default is the cpu count
+    :param queue_size: max images queued for resizing, default is 2 x workers
+    :param done: optional callback, called with each result in order
+    :param fast: faster, lower quality resize, see resize_image_data()
+    :return: list of results from resize_image, in the same order as image_paths
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if queue_size is None:
+        queue_size = workers * 2
+
+    results = []
+    def collect(job):
+        retval = job.result()
+        results.append(retval)
+        if done is not None:
+            done(retval)
+
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = deque()
+        for image_path in image_paths:
+            #Wait for the oldest job when the queue is full, keeps results in order
+            if len(jobs) >= queue_size:
+                collect(jobs.popleft())
+            jobs.append(pool.submit(resize_image, image_path, resize_to, fast=fast))
+        while len(jobs):
+            collect(jobs.popleft())
+
+    return results
+
+#Only these file types are worth deflating, everything else (GeoTIFF, LAZ, JPEG, GLB...)
+#is already compressed and is stored as-is
+DEFLATE_EXTENSIONS = ['.obj', '.mtl', '.ply', '.las', '.csv', '.txt', '.json', '.geojson', '.xml', '.prj', '.xyz']
+
+def compress_type(filename):
+    """
+    Get the zip compression to use for a file, based on its extension
+
+    Parameters
+    ----------
+    filename: str
+        file name or path
+
+    Returns
+    -------
+    int
+        zipfile.ZIP_DEFLATED for compressible formats, zipfile.ZIP_STORED for all others
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in DEFLATE_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def _deflate_file(filepath, level=6, block_size=1048576):
+    #Deflate a file into a temporary raw (headerless) stream,
+    #returns the temp file, crc and uncompressed / compressed sizes
+    import zlib
+    import tempfile
+    crc = 0
+    size = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    tmp = tempfile.TemporaryFile()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            tmp.write(compressor.compress(chunk))
+    tmp.write(compressor.flush())
+    return tmp, crc, size, tmp.tell()
+
+#ZipFile has no public API to add a member that is already compressed,
+#_write_deflated() uses its internals, which are unchanged in these Python versions
+ZIP_RAW_VERSIONS = ((3, 6), (3, 13))
+
+def _zip_raw_supported(zfile):
+    #Can members deflated by _deflate_file be written to zfile directly
+    return (ZIP_RAW_VERSIONS[0] <= sys.version_info[:2] <= ZIP_RAW_VERSIONS[1]
+            and all(hasattr(zfile, a) for a in ['fp', 'start_dir', 'filelist', 'NameToInfo', '_lock', '_didModify'])
+            and hasattr(zipfile.ZipInfo, 'FileHeader'))
+
+def _write_deflated(zfile, filepath, arcname, deflated):
+    #Append a member that has already been deflated by _deflate_file
+    #(this is what ZipFile.write does, minus the compression, see _zip_raw_supported)
+    tmp, crc, size, compress_size = deflated
+    zinfo = zipfile.ZipInfo.from_file(filepath, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = compress_size
+    #Same checks as ZipFile.write
+    if zinfo.filename in zfile.NameToInfo:
+        import warnings
+        warnings.warn('Duplicate name: %r' % zinfo.filename, stacklevel=3)
+    if getattr(zfile, '_writing', False):
+        raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+    zip64 = size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT
+    with zfile._lock:
+        zfile.fp.seek(zfile.start_dir)
+        zinfo.header_offset = zfile.start_dir
+        zfile.fp.write(zinfo.FileHeader(zip64))
+        tmp.seek(0)
+        shutil.copyfileobj(tmp, zfile.fp, 1048576)
+        tmp.close()
+        zfile.filelist.append(zinfo)
+        zfile.NameToInfo[zinfo.filename] = zinfo
+        zfile.start_dir = zfile.fp.tell()
+        zfile._didModify = True
+
+def zip_files(outfn, files, workers=None, level=6):
+    """
+    Write a zip archive, choosing the compression per file with compress_type()
+
+    Compressible members are deflated in parallel on a thread pool (zlib releases the GIL)
+    while the already compressed members are copied into the archive.
+    On Python versions outside ZIP_RAW_VERSIONS the members are compressed one at a time
+
+    Parameters
+    ----------
+    outfn: str
+        zip file to write
+    files: list
+        list of (path, arcname) tuples to add to the archive
+    workers: int
+        number of compression threads, default is the cpu count
+    level: int
+        deflate compression level
+
+    Returns
+    -------
+    str
+        zip file written
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with zipfile.ZipFile(outfn, "w", allowZip64=True) as zfile, ThreadPoolExecutor(workers) as pool:
+        if not _zip_raw_supported(zfile):
+            for f, arcname in files:
+                zfile.write(f, arcname, compress_type(f), level)
+            return outfn
+        #Start compressing first, then copy the stored files while that runs
+        jobs = [(f, arcname, pool.submit(_deflate_file, f, level)) for f, arcname in files
+                if compress_type(f) == zipfile.ZIP_DEFLATED]
+        for f, arcname in files:
+            if compress_type(f) == zipfile.ZIP_STORED:
+                zfile.write(f, arcname, zipfile.ZIP_STORED)
+        for f, arcname, job in jobs:
+            _write_deflated(zfile, f, arcname, job.result())
+    return outfn
+
+def cache_path(*parts):
+    """
+    Get a path in the local ASDC cache directory, parent directories are created
+
+    The cache is in ~/.cache/asdc unless the ASDC_CACHE_DIR env variable is set
+
+    Parameters
+    ----------
+    parts: str
+        path components to append to the cache directory
+
+    Returns
+    -------
+    str
+        full path
+    """
+    base = os.getenv('ASDC_CACHE_DIR', os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'asdc'))
+    path = os.path.join(base, *[str(p) for p in parts])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def file_hash(filepath, block_size=1048576):
+    """
+    Get the SHA1 hash of a file's contents
+
+    Parameters
+    ----------
+    filepath: str
+        file to hash
+    block_size: int
+        size of chunks to read
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    import hashlib
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+#Tokens in the cache must still be valid for this many seconds to be used
+TOKEN_CACHE_MARGIN = 30
+#Only the fields needed by clients are cached, not the refresh_token
+TOKEN_CACHE_FIELDS = ['access_token', 'token_type', 'expires_at', 'id_token']
+
+def token_cache_file():
+    """
+    Get the path of the token cache file, shared by the server and all kernels
+
+    Named servers each get their own file, as for server_socket_path()
+
+    Returns
+    -------
+    str
+        full path
+    """
+    server = os.getenv('JUPYTERHUB_SERVER_NAME', '')
+    return cache_path(f'tokens-{server}.json' if server else 'tokens.json')
+
+def write_token_cache(tokens):
+    """
+    Write the current access token to the token cache file, readable only by the user
+
+    The file is written to a temporary name and renamed so readers never see a partial file
+
+    Parameters
+    ----------
+    tokens: dict
+        token data, as returned by the OAuth2 token endpoint
+    """
+    data = {k: tokens[k] for k in TOKEN_CACHE_FIELDS if k in tokens}
+    fn = token_cache_file()
+    tmpfn = f"{fn}.{os.getpid()}"
+    fd = os.open(tmpfn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        #Ensure the permissions even if the file already existed
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmpfn, fn)
+    except (OSError) as e:
+        logger.error(f"Failed to write token cache: {e}")
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+
+def read_token_cache(margin=TOKEN_CACHE_MARGIN):
+    """
+    Read the access token from the token cache file
+
+    Parameters
+    ----------
+    margin: int
+        seconds the token must remain valid for
+
+    Returns
+    -------
+    dict
+        token data, or None if there is no cached token, it has expired,
+        or the file is accessible to other users
+    """
+    fn = token_cache_file()
+    try:
+        with open(fn, 'r') as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o077:
+                logger.error(f"Ignoring token cache with insecure permissions: {fn}")
+                return None
+            data = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        return None
+    if not 'access_token' in data or data.get('expires_at', 0) - margin <= time.time():
+        return None
+    return data
+
+def clear_token_cache():
+    """
+    Remove the token cache file
+    """
+    try:
+        os.remove(token_cache_file())
+    except (FileNotFoundError) as e:
+        pass
+
+def prefetch_progress_file(filename):
+    """
+    Get the progress file for a background asset download by the server
+
+    Parameters
+    ----------
+    filename: str
+        destination file of the download
+
+    Returns
+    -------
+    str
+        progress filename, alongside the destination file
+    """
+    path, fn = os.path.split(filename)
+    return os.path.join(path, f'.{fn}.prefetch.json')
+
+def write_prefetch_progress(filename, progress):
+    """
+    Write the progress of a background download, see read_prefetch_progress()
+    """
+    fn = prefetch_progress_file(filename)
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(dict(progress, time=time.time()), f)
+    os.replace(fn + '.tmp', fn)
+
+def read_prefetch_progress(filename):
+    """
+    Read the progress of a background download
+
+    Parameters
+    ----------
+    filename: str
+        destination file of the download
+
+    Returns
+    -------
+    dict
+        status ('downloading', 'done' or 'error'), bytes, total, time (last update),
+        or None if there is no background download
+    """
+    try:
+        with open(prefetch_progress_file(filename), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        return None
+
+def server_socket_path():
+    """
+    Get the path of the unix domain socket the local ASDC server listens on
+
+    Uses XDG_RUNTIME_DIR if available, otherwise the cache directory,
+    named servers each get their own socket
+
+    Returns
+    -------
+    str
+        full path
+    """
+    server = os.getenv('JUPYTERHUB_SERVER_NAME', '')
+    fn = f'server-{server}.sock' if server else 'server.sock'
+    runtime = os.getenv('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        path = os.path.join(runtime, 'asdc', fn)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        return path
+    return cache_path(fn)
 
 def default_inputs():
     #Get default inputs from env
@@ -0,0 +1,104 @@
+"""
+# ASDC image metadata benchmark
+
+Times read_metadata() (JPEG/TIFF header only) against opening the images with PIL,
+and fails if the header reader disagrees with PIL on any of the test images
+
+The test set includes drone style JPEGs with the XMP segment after the EXIF one,
+the gimbal angles in the XMP must reach the index_images() rows
+
+Usage:
+python benchmarks/image_metadata.py [--images N]
+"""
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+XMP = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+       b'<rdf:Description xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" drone-dji:GimbalPitchDegree="-90.0"'
+       b' drone-dji:GimbalYawDegree="45.5" drone-dji:GimbalRollDegree="0.0"/></rdf:RDF></x:xmpmeta>')
+
+def write_drone_jpeg(path, size=(64, 48)):
+    #JPEG with an EXIF APP1 (GPS) followed by an XMP APP1, as written by DJI drones
+    import io
+    from PIL import Image
+    import piexif
+    gps = {piexif.GPSIFD.GPSLatitudeRef: b'S', piexif.GPSIFD.GPSLatitude: ((37, 1), (48, 1), (0, 1)),
+           piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((144, 1), (57, 1), (0, 1))}
+    exif = piexif.dump({'0th': {piexif.ImageIFD.Make: b'DJI'}, 'Exif': {}, 'GPS': gps})
+    data = io.BytesIO()
+    Image.new('RGB', size, (90, 120, 60)).save(data, 'JPEG', exif=exif)
+    data = data.getvalue()
+    #Insert the XMP segment after the EXIF segment
+    end = 2
+    while data[end:end+2] != b'\xff\xe1':
+        end += 2 + int.from_bytes(data[end+2:end+4], 'big')
+    end += 2 + int.from_bytes(data[end+2:end+4], 'big')
+    payload = b'http://ns.adobe.com/xap/1.0/\x00' + XMP
+    segment = b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload
+    with open(path, 'wb') as f:
+        f.write(data[:end] + segment + data[end:])
+
+def check(folder, files):
+    #Returns a list of errors, compares read_metadata() with PIL
+    from PIL import Image
+    from asdc.utils import read_metadata
+    from asdc.images import index_images
+    errors = []
+    for fn in files:
+        meta = read_metadata(fn)
+        with Image.open(fn) as im:
+            if meta['size'] != im.size:
+                errors += [f"{fn}: size {meta['size']} != {im.size}"]
+            if meta['exif'] != im.info.get('exif'):
+                errors += [f"{fn}: EXIF differs from PIL"]
+            xmp = im.info.get('xmp')
+            if xmp is not None and meta['xmp'] != xmp:
+                errors += [f"{fn}: XMP differs from PIL"]
+        if meta['xmp'] is None:
+            errors += [f"{fn}: XMP not found"]
+    index = index_images(folder, cache=False)
+    for col, value in [('pitch', -90.0), ('yaw', 45.5), ('roll', 0.0)]:
+        bad = [p for p, v in zip(index['path'], index[col]) if math.isnan(v) or v != value]
+        if len(bad):
+            errors += [f"index_images {col} wrong for {len(bad)} images, eg: {bad[0]}"]
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the image header reader")
+    parser.add_argument('--images', type=int, default=200, help="number of test images")
+    args = parser.parse_args()
+
+    from PIL import Image
+    from asdc.utils import read_metadata
+    with tempfile.TemporaryDirectory() as folder:
+        files = [os.path.join(folder, f'{i}.jpg') for i in range(args.images)]
+        for fn in files:
+            write_drone_jpeg(fn)
+
+        start = time.perf_counter()
+        for fn in files:
+            with Image.open(fn) as im:
+                im.getexif()
+        pil = time.perf_counter() - start
+        start = time.perf_counter()
+        for fn in files:
+            read_metadata(fn)
+        header = time.perf_counter() - start
+        print(f"{args.images} images: PIL {pil * 1000:.1f}ms, read_metadata {header * 1000:.1f}ms")
+
+        errors = check(folder, files)
+    for e in errors[:10]:
+        print("FAIL: " + e)
+    if not len(errors):
+        print("OK: header metadata matches PIL")
+    return 1 if len(errors) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
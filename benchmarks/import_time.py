@@ -0,0 +1,112 @@
+"""
+# ASDC import time benchmark
+
+Measures the time taken by "import asdc" in fresh interpreters and fails
+if it is over budget, or if any of the heavy dependencies were loaded at import
+
+Also checks the deferred imports work when first used from many threads at once,
+as the image functions do with their thread pools
+
+Usage:
+python benchmarks/import_time.py [--budget MILLISECONDS] [--runs N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+#These must only be loaded on first use
+LAZY_MODULES = ['PIL.Image', 'piexif', 'jwt', 'slugify', 'requests_toolbelt', 'dotenv',
+                'numpy', 'tqdm', 'ipywidgets', 'IPython.display']
+
+CHECK_SCRIPT = """
+import sys
+import asdc
+loaded = [m for m in sys.argv[1:] if m in sys.modules]
+print(','.join(loaded))
+"""
+
+THREADED_SCRIPT = """
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import asdc
+folder = sys.argv[1]
+files = asdc.list_images(folder)
+def first_use(fn):
+    asdc.read_exif(fn)
+    asdc.resize_image_data(fn, 8)
+with ThreadPoolExecutor(len(files)) as pool:
+    list(pool.map(first_use, files))
+asdc.image_hashes(files, workers=len(files))
+"""
+
+def threaded_first_use(env, runs=5, images=16):
+    #Returns the error output of any failed runs
+    import tempfile
+    from PIL import Image
+    import piexif
+    errors = []
+    with tempfile.TemporaryDirectory() as folder:
+        exif = piexif.dump({'0th': {piexif.ImageIFD.Make: b'Test'}, 'Exif': {}, 'GPS': {}})
+        for i in range(images):
+            Image.new('RGB', (64, 48), (i * 10, 0, 0)).save(f'{folder}/{i}.jpg', exif=exif)
+        for i in range(runs):
+            r = subprocess.run([sys.executable, '-c', THREADED_SCRIPT, folder],
+                               capture_output=True, text=True, env=env)
+            if r.returncode != 0:
+                errors += [r.stderr.strip().splitlines()[-1]]
+    return errors
+
+def import_time(env):
+    #Total cumulative time of the asdc package import in microseconds, from -X importtime
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import asdc'],
+                       capture_output=True, text=True, env=env, check=True)
+    for line in r.stderr.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'asdc':
+            return int(fields[1]) / 1000.0
+    raise(Exception("Import time for asdc not found in output"))
+
+def loaded_modules(env):
+    r = subprocess.run([sys.executable, '-c', CHECK_SCRIPT] + LAZY_MODULES,
+                       capture_output=True, text=True, env=env, check=True)
+    return list(filter(None, r.stdout.strip().split(',')))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the asdc import time budget")
+    parser.add_argument('--budget', type=float, default=float(os.getenv('ASDC_IMPORT_BUDGET_MS', 150)),
+                        help="maximum median import time in milliseconds")
+    parser.add_argument('--runs', type=int, default=7, help="number of fresh interpreters to time")
+    args = parser.parse_args()
+
+    #Run from the source tree, without any user inputs file
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env.pop('ASDC_INPUT_FILE', None)
+
+    #First run is discarded, warms up the bytecode cache
+    import_time(env)
+    times = [import_time(env) for i in range(args.runs)]
+    median = statistics.median(times)
+    print(f"import asdc: median {median:.1f}ms, min {min(times):.1f}ms, max {max(times):.1f}ms ({args.runs} runs)")
+
+    failed = False
+    loaded = loaded_modules(env)
+    if len(loaded):
+        print("FAIL: loaded at import: " + ', '.join(loaded))
+        failed = True
+    errors = threaded_first_use(env)
+    if len(errors):
+        print("FAIL: threaded first use: " + '; '.join(errors))
+        failed = True
+    if median > args.budget:
+        print(f"FAIL: over budget of {args.budget:.0f}ms")
+        failed = True
+    if not failed:
+        print(f"OK: within budget of {args.budget:.0f}ms")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
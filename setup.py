@@ -11,7 +11,14 @@ setuptools.setup(
     package_dir={
         "": ".",
         "asdc/noteboooks": "./asdc/notebooks",},
-    install_requires=['jupyter-server-proxy', 'pillow', 'qrcode','tqdm', 'python-dotenv', 'python-slugify', 'requests-toolbelt', 'piexif', 'pyjwt', 'authlib', 'browser_cookie3'],
+    install_requires=['jupyter-server-proxy', 'pillow', 'qrcode','tqdm', 'python-dotenv', 'python-slugify', 'requests-toolbelt', 'piexif', 'pyjwt', 'authlib', 'browser_cookie3', 'numpy'],
+    extras_require={
+        #Local exports with asdc.export (export_asset(..., local=True))
+        'export': ['laspy[lazrs]', 'pyproj', 'rasterio'],
+        #Resizing multiband high bit depth TIFFs
+        'multiband': ['tifffile'],
+        'all': ['laspy[lazrs]', 'pyproj', 'rasterio', 'tifffile'],
+    },
     entry_points={
         'jupyter_serverproxy_servers': [
             # name = packagename:function_name